@@ -1,15 +1,17 @@
-from cStringIO import StringIO
+from io import BytesIO
 from datetime import datetime
-from Queue import Queue
+from queue import Queue
 from uuid import uuid4
 import hashlib
 
 import boto3
 import pytest
+from botocore.exceptions import ClientError
 
 from zfs3backup.pput import (UploadSupervisor, UploadWorker, StreamHandler,
                      Result, WorkerCrashed, multipart_etag, parse_metadata,
-                     retry, UploadException)
+                     retry, is_retriable, UploadException,
+                     BufferPool)
 from zfs3backup.config import get_config
 
 
@@ -21,7 +23,7 @@ class ReadOnlyFile(object):
     """A read-only file like object.
     Helps ensure we don't accidentally mutate the fixture between test runs.
     """
-    def __init__(self, fd, allowed=('read', 'seek')):
+    def __init__(self, fd, allowed=('read', 'readinto', 'seek')):
         self._fd = fd
         self._allowed = set(allowed)
 
@@ -39,17 +41,17 @@ def sample_data():
     """
     global _cached_sample_data
     if _cached_sample_data is None:
-        data = StringIO()
-        chars = "".join(chr(i) for i in xrange(256))
-        for count in xrange(6):
-            cc = chr(count)
-            for _ in xrange(2 * 1024):
+        data = BytesIO()
+        chars = bytes(range(256))
+        for count in range(6):
+            cc = bytes([count])
+            for _ in range(2 * 1024):
                 # each iteration adds 1MB
                 # each 1MB chunk is made up of an alternation of the block's index (zero based)
                 # and an incrementing counter (overflows to 0 several times)
                 # the first block will be: 00 00 00 01 00 02 ... 00 ff 00 00 ... 00 ff
                 data.write(
-                    "".join(cc+chars[i] for i in xrange(256))
+                    b"".join(cc + chars[i:i+1] for i in range(256))
                 )
         print("wrote {} MB" .format(data.tell() / 1024.0 / 1024.0))
         # give the test a read-only file to avoid accidentally modifying the data between tests
@@ -66,17 +68,17 @@ def test_multipart_etag(sample_data):
             break
         digest = hashlib.md5()
         digest.update(chunk)
-        digests.append(digest.hexdigest())
+        digests.append(digest.digest())
     assert multipart_etag(digests) == '"d229c1fc0e509475afe56426c89d2724-2"'
 
 
 def test_stream_handler():
-    stream_handler = StreamHandler(StringIO("aabbccdde"), chunk_size=2)
+    stream_handler = StreamHandler(BytesIO(b"aabbccdde"), chunk_size=2)
     chunks = []
     while not stream_handler.finished:
         chunk = stream_handler.get_chunk()
         chunks.append(chunk)
-    assert chunks == ['aa', 'bb', 'cc', 'dd', 'e']
+    assert [c.data for c in chunks] == [b'aa', b'bb', b'cc', b'dd', b'e']
 
 
 def test_handle_results():
@@ -86,23 +88,72 @@ def test_handle_results():
     sup.inbox.put(Result(success=True, traceback=None, index=1, md5='a', etag='etag1'))
     sup.inbox.put(Result(success=True, traceback=None, index=3, md5='c', etag='etag3'))
     sup.inbox.put(Result(success=True, traceback=None, index=2, md5='b', etag='etag2'))
-    sup._handle_results()
-    assert sorted(sup.results) == [(1, 'a', 'etag1'), (2, 'b', 'etag2'), (3, 'c', 'etag3')]
+    for _ in range(3):
+        sup._handle_result()
+    assert sup.results == [('a', 'etag1', None), ('b', 'etag2', None), ('c', 'etag3', None)]
     assert sup._pending_chunks == 0
 
 
+def test_dynamic_chunk_size():
+    mega = 1024 * 1024
+    sup = UploadSupervisor(None, None, None, estimated=100 * mega)
+    sup._base_chunk_size = 10 * mega
+    assert sup.dynamic_chunk_size() == 10 * mega  # nothing measured yet
+    for _ in range(sup.min_samples):
+        sup._update_throughput(2 * mega)
+    assert sup.dynamic_chunk_size() == 20 * mega  # 2M/s * 10s per part
+    for _ in range(10):
+        sup._update_throughput(100 * mega)
+    assert sup.dynamic_chunk_size() == 40 * mega  # capped to 4x the initial size
+    for _ in range(50):
+        sup._update_throughput(1024)
+    assert sup.dynamic_chunk_size() == 5 * mega  # never below the S3 minimum
+
+
+def test_buffer_pool():
+    pool = BufferPool(2)
+    first, second = pool.acquire(4), pool.acquire(4)
+    assert len(first) == len(second) == 4
+    pool.release(first)
+    assert pool.acquire(4) is first  # nothing new is allocated once count is reached
+    pool.release(first)
+    assert pool.acquire(2) is first and len(first) == 2  # trimmed to the chunk size
+    pool.release(first)
+    grown = pool.acquire(8)  # replaced rather than kept at the old size
+    assert grown is not first and len(grown) == 8
+
+
+def test_stream_handler_with_pool():
+    pool = BufferPool(2)
+    stream_handler = StreamHandler(BytesIO(b"aabbc"), chunk_size=2, pool=pool)
+    chunk = stream_handler.get_chunk()
+    assert chunk.data == b'aa'
+    assert isinstance(chunk.data, bytearray)  # sent as is, no file wrapper copying it in blocks
+    assert chunk.pool is pool
+    pool.release(chunk.data)
+    held = [stream_handler.get_chunk(), stream_handler.get_chunk()]
+    assert [c.data for c in held] == [b'bb', b'c']
+    # both buffers are in use, reaching EOF mustn't wait for one
+    assert stream_handler.get_chunk() is None
+    assert stream_handler.finished
+
+
 class FakeMultipart(object):
     def __init__(self, name):
         self._name = name
         self.id = str(uuid4())
         self.key_name = str(uuid4())
+        self.bucket_name = 'test-bucket'
+        self.object_key = name
         self._completed = False
         self._canceled = False
+        self.parts = None
 
     def complete(self, **kwargs):
         if self._completed:
             raise AssertionError('multipart already completed')
         self._completed = True
+        self.parts = kwargs['MultipartUpload']['Parts']
 
     def abort(self):
         if self._canceled:
@@ -128,13 +179,14 @@ class FakeObject(object):
         self.bucket = bucket
 
     def initiate_multipart_upload(self, **kwargs):
+        self.initiate_args = kwargs
         self._multipart = FakeMultipart(self.name)
         return self._multipart
 
 
 class DummyWorker(UploadWorker):
     def upload_part(self, index, chunk):
-        return hashlib.md5(chunk).hexdigest(), 'etag-{}'.format(index)
+        return hashlib.md5(chunk.data).digest(), 'etag-{}'.format(index), None
 
 
 def test_supervisor_loop(sample_data):
@@ -146,8 +198,33 @@ def test_supervisor_loop(sample_data):
     assert sup.obj._multipart._completed
 
 
+class CRCWorker(UploadWorker):
+    def upload_part(self, index, chunk):
+        return hashlib.md5(chunk.data).digest(), 'etag-{}'.format(index), 'crc-{}'.format(index)
+
+
+def test_supervisor_loop_with_crc32c(sample_data):
+    stream_handler = StreamHandler(sample_data)
+    bucket = FakeBucket()
+    sup = UploadSupervisor(stream_handler, 'test', bucket=bucket, checksum='crc32c')
+    sup.main_loop(worker_class=CRCWorker)
+    assert sup.obj.initiate_args['ChecksumAlgorithm'] == 'CRC32C'
+    assert sup.obj._multipart.parts == [
+        {'PartNumber': 1, 'ETag': 'etag-1', 'ChecksumCRC32C': 'crc-1'},
+        {'PartNumber': 2, 'ETag': 'etag-2', 'ChecksumCRC32C': 'crc-2'},
+    ]
+
+
+def test_supervisor_loop_with_pool(sample_data):
+    stream_handler = StreamHandler(sample_data, pool=BufferPool(3))
+    bucket = FakeBucket()
+    sup = UploadSupervisor(stream_handler, 'test', bucket=bucket)
+    etag = sup.main_loop(worker_class=DummyWorker)
+    assert etag == '"d229c1fc0e509475afe56426c89d2724-2"'
+
+
 def test_zero_data(sample_data):
-    stream_handler = StreamHandler(StringIO())
+    stream_handler = StreamHandler(BytesIO())
     bucket = FakeBucket()
     sup = UploadSupervisor(stream_handler, 'test', bucket=bucket)
     with pytest.raises(UploadException):
@@ -159,7 +236,7 @@ class ErrorWorker(UploadWorker):
     def upload_part(self, index, chunk):
         if index == 2:
             raise Exception("Testing worker crash")
-        return hashlib.md5(chunk).hexdigest(), 'etag-{}'.format(index)
+        return hashlib.md5(chunk.data).digest(), 'etag-{}'.format(index), None
 
 
 def test_supervisor_loop_with_worker_crash(sample_data):
@@ -178,20 +255,42 @@ class Boom(object):
     def __init__(self):
         self.count = 0
 
-    @retry(3)
+    @retry(3, retriable=lambda excp: isinstance(excp, BoomException), base_delay=0)
     def call(self):
         self.count += 1
         raise BoomException("Boom!")
 
+    @retry(3, base_delay=0)
+    def fatal(self):
+        self.count += 1
+        raise ValueError("not worth retrying")
+
 
 def test_retry_decorator():
     boom = Boom()
     with pytest.raises(BoomException) as excp_info:
-        for _ in xrange(3):
+        for _ in range(3):
             boom.call()
     assert boom.count == 3
 
 
+def test_retry_decorator_fatal_error():
+    boom = Boom()
+    with pytest.raises(ValueError):
+        boom.fatal()
+    assert boom.count == 1
+
+
+def test_is_retriable():
+    throttled = ClientError({'Error': {'Code': 'SlowDown'}}, 'UploadPart')
+    denied = ClientError(
+        {'Error': {'Code': 'AccessDenied'}, 'ResponseMetadata': {'HTTPStatusCode': 403}}, 'UploadPart')
+    assert is_retriable(throttled)
+    assert not is_retriable(denied)
+    assert is_retriable(UploadException("status 500"))
+    assert not is_retriable(KeyError('ETag'))
+
+
 @pytest.mark.with_s3
 def test_integration(sample_data):
     cfg = get_config()
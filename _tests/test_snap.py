@@ -1,19 +1,24 @@
 # pylint: disable=redefined-outer-name,protected-access
 from collections import OrderedDict
-from cStringIO import StringIO
+from io import BytesIO, StringIO
 import contextlib
+import json
 import string
+import subprocess
 import sys
+import threading
 import random
 import os.path
+import shlex
 
 import boto3
 import pytest
+from botocore.exceptions import ClientError
 
 from zfs3backup.config import get_config
 from zfs3backup.snap import (list_snapshots, S3SnapshotManager, ZFSSnapshotManager,
                      PairManager, CommandExecutor, IntegrityError, SoftError,
-                     _humanize, handle_soft_errors)
+                     _humanize, _stream_lines, handle_soft_errors)
 
 
 MEGA = 1024 ** 2
@@ -22,7 +27,8 @@ TERA = 1024 ** 4
 
 
 class FakeBucket(object):
-    rand_prefix = 'test-' + ''.join([random.choice(string.ascii_letters) for _ in xrange(8)]) + '/'
+    name = 'fake-bucket'
+    rand_prefix = 'test-' + ''.join([random.choice(string.ascii_letters) for _ in range(8)]) + '/'
     fake_data = {
         "pool/fs@snap_0": {'parent': 'pool/fs@snap_expired'},
         "pool/fs@snap_1_f": {'isfull': 'true', 'compressor': 'pigz1'},
@@ -48,12 +54,39 @@ class FakeBucket(object):
     def objects(self):
         return FakeObjects(self)
 
+    @property
+    def meta(self):
+        return FakeBucketMeta(FakeClient(self))
+
+
+class FakeBucketMeta(object):
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeClient(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def head_object(self, Bucket, Key):
+        if hasattr(self.bucket, 'client_heads'):
+            self.bucket.client_heads.append(Key)
+        return {'Metadata': self.bucket.Object(Key).metadata}
+
 class FakeObject(object):
     def __init__(self, bucket, name, metadata=None):
         self.name = name
         self.metadata = metadata
         self.bucket = bucket
         self.content_length = 1234
+        self.e_tag = '"fake"'
+
+    def load(self):
+        pass
+
+    def get(self):
+        # the fixture has no manifest
+        raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
 
     @property
     def key(self):
@@ -68,6 +101,7 @@ class FakeObjectSummary(object):
         self.metadata = metadata
         self.bucket = bucket
         self.size = 1234
+        self.e_tag = '"fake"'
 
     @property
     def key(self):
@@ -88,7 +122,7 @@ def write_s3_data():
     """
     cfg = get_config()
     bucket = boto3.resource('s3').Bucket(cfg['BUCKET'])
-    for name, metadata in FakeBucket.fake_data.iteritems():
+    for name, metadata in FakeBucket.fake_data.items():
         key = bucket.Object(os.path.join(FakeBucket.rand_prefix, name))
         key.put(Body="spam", Metadata=metadata)
     return bucket
@@ -98,7 +132,7 @@ def write_s3_data():
     scope='module',
     params=[
         FakeBucket,
-        pytest.mark.with_s3(write_s3_data),
+        pytest.param(write_s3_data, marks=pytest.mark.with_s3),
     ],
     ids=['fake_bucket', 'with_s3']
 )
@@ -137,6 +171,11 @@ def test_healthy_full(s3_manager):
     assert snap.is_healthy
 
 
+def test_snapshot_repr(s3_manager):
+    assert repr(s3_manager.get('pool/fs@snap_1_f')) == "<Snapshot pool/fs@snap_1_f [full]>"
+    assert repr(s3_manager.get('pool/fs@snap_2')) == "<Snapshot pool/fs@snap_2 [pool/fs@snap_1_f]>"
+
+
 def test_healthy_incremental(s3_manager):
     snap = s3_manager.get('pool/fs@snap_3')
     assert snap.is_full is False
@@ -159,6 +198,124 @@ def test_unhealthy_cycle(s3_manager):
     assert snap.parent.reason_broken == 'cycle detected'
 
 
+class LongChainBucket(FakeBucket):
+    """A full snapshot followed by a chain of incrementals much deeper than the recursion limit"""
+    def __init__(self, length):
+        self.fake_data = {"pool/fs@snap_0": {'isfull': 'true'}}
+        for i in range(1, length):
+            self.fake_data[f"pool/fs@snap_{i}"] = {'parent': f"pool/fs@snap_{i - 1}"}
+        self.fake_data["pool/fs@snap_orphan"] = {'parent': "pool/fs@snap_expired"}
+        self.fake_data["pool/fs@snap_after_orphan"] = {'parent': "pool/fs@snap_orphan"}
+
+
+def test_health_long_chain():
+    length = sys.getrecursionlimit() * 3
+    s3_manager = S3SnapshotManager(
+        LongChainBucket(length), s3_prefix=FakeBucket.rand_prefix, snapshot_prefix="pool/fs@snap_")
+    assert s3_manager.get(f'pool/fs@snap_{length - 1}').is_healthy
+    assert all(snap.is_healthy for snap in s3_manager.list() if 'orphan' not in snap.name)
+    assert s3_manager.get('pool/fs@snap_after_orphan').reason_broken == 'parent broken'
+    assert s3_manager.get('pool/fs@snap_orphan').reason_broken == 'missing parent'
+
+
+class CountingBucket(FakeBucket):
+    """Records the keys Object() is called for, each one is a HEAD request with boto
+    except for the manifest which is a GET. client_heads has the ones made through
+    the client.
+    """
+    def __init__(self):
+        self.heads = []
+        self.client_heads = []
+
+    def Object(self, name):
+        if not name.endswith(S3SnapshotManager.MANIFEST):
+            self.heads.append(name)
+        return super(CountingBucket, self).Object(name)
+
+
+def test_metadata_is_lazy():
+    bucket = CountingBucket()
+    s3_manager = S3SnapshotManager(
+        bucket, s3_prefix=FakeBucket.rand_prefix, snapshot_prefix="pool/fs@snap_")
+    snap = s3_manager.get('pool/fs@snap_2')
+    assert snap.size == 1234
+    assert bucket.heads == []  # listing doesn't fetch any metadata
+    assert snap.parent_name == 'pool/fs@snap_1_f'
+    assert snap.compressor is None
+    assert bucket.heads == [FakeBucket.rand_prefix + 'pool/fs@snap_2']  # only fetched once
+
+
+def test_prefetch_metadata():
+    bucket = CountingBucket()
+    s3_manager = S3SnapshotManager(
+        bucket, s3_prefix=FakeBucket.rand_prefix, snapshot_prefix="pool/fs@snap_")
+    s3_manager.prefetch_metadata(['pool/fs@snap_2', 'pool/fs@snap_3', 'pool/fs@no_such_snap'])
+    assert sorted(bucket.heads) == [
+        FakeBucket.rand_prefix + 'pool/fs@snap_2', FakeBucket.rand_prefix + 'pool/fs@snap_3']
+    assert s3_manager.get('pool/fs@snap_3').parent_name == 'pool/fs@snap_2'
+    s3_manager.prefetch_metadata()
+    assert len(bucket.heads) == len(FakeBucket.fake_data)  # nothing is fetched twice
+    assert sorted(bucket.client_heads) == sorted(bucket.heads)  # the threads share the client, not the resource
+    # all the metadata is there, so health is worked out right away
+    health = {snap.name: snap._reason_broken for snap in s3_manager.list() if snap._healthy is False}
+    assert health == {
+        'pool/fs@snap_0': 'missing parent',
+        'pool/fs@snap_4_mp': 'missing parent',
+        'pool/fs@snap_5': 'parent broken',
+        'pool/fs@snap_6_cycle': 'cycle detected',
+        'pool/fs@snap_7_cycle': 'cycle detected',
+    }
+    assert all(snap._healthy is not None for snap in s3_manager.list())
+
+
+class FakeManifestObject(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get(self):
+        return {'Body': BytesIO(self.bucket.manifest)}
+
+    def put(self, Body):
+        self.bucket.manifest = Body
+
+
+class ManifestBucket(CountingBucket):
+    def __init__(self, manifest):
+        super(ManifestBucket, self).__init__()
+        self.manifest = manifest
+
+    def Object(self, name):
+        if name.endswith(S3SnapshotManager.MANIFEST):
+            return FakeManifestObject(self)
+        return super(ManifestBucket, self).Object(name)
+
+
+def test_manifest_metadata():
+    manifest = [
+        {'name': 'pool/fs@snap_1_f', 'etag': '"fake"', 'metadata': {'isfull': 'true'}},
+        # a stale entry, the key was overwritten since
+        {'name': 'pool/fs@snap_2', 'etag': '"old"', 'metadata': {'parent': 'pool/fs@snap_0'}},
+        # an expired snapshot that's gone from the listing
+        {'name': 'pool/fs@snap_expired', 'etag': '"fake"', 'metadata': {'isfull': 'true'}},
+        # another dataset backed up under the same s3 prefix
+        {'name': 'pool/other@snap_1', 'etag': '"fake"', 'metadata': {'isfull': 'true'}},
+    ]
+    bucket = ManifestBucket(''.join(json.dumps(entry) + '\n' for entry in manifest).encode())
+    s3_manager = S3SnapshotManager(
+        bucket, s3_prefix=FakeBucket.rand_prefix, snapshot_prefix="pool/fs@snap_")
+    s3_manager.prefetch_metadata(['pool/fs@snap_1_f', 'pool/fs@snap_2'])
+    assert bucket.heads == [FakeBucket.rand_prefix + 'pool/fs@snap_2']
+    assert s3_manager.get('pool/fs@snap_1_f').is_full
+    assert s3_manager.get('pool/fs@snap_2').parent_name == 'pool/fs@snap_1_f'
+
+    s3_manager.update_manifest(['pool/fs@snap_2', 'pool/fs@snap_3'])
+    entries = [json.loads(line) for line in bucket.manifest.decode().splitlines()]
+    assert [(e['name'], e['etag']) for e in entries] == [
+        ('pool/fs@snap_1_f', '"fake"'), ('pool/fs@snap_2', '"fake"'),
+        ('pool/other@snap_1', '"fake"'), ('pool/fs@snap_3', '"fake"')]
+    assert entries[3]['metadata'] == {'parent': 'pool/fs@snap_2', 'isfull': 'false'}
+
+
 class FakeZFSManager(ZFSSnapshotManager):
     _expected = (
         # pool is a different zfs dataset, the s3 fixtures don't include it
@@ -182,57 +339,45 @@ class FakeZFSManager(ZFSSnapshotManager):
         super(FakeZFSManager, self).__init__(*a, **kwa)
 
     def _list_snapshots(self):
-        return self._expected
+        return StringIO(self._expected)  # zfs list output is streamed line by line
+
+    def datasets(self):
+        return []  # none of the tests expect a local dataset to exist
 
 
 def test_list_local_snapshots():
     zfs = FakeZFSManager(fs_name='pool/fs', snapshot_prefix='snap_')
-    expected = {
-        'pool': OrderedDict([  # _parse_snapshots returns snapshots for ALL filesystems
-            ('snap_p1', {
-                'name': 'pool@snap_p1',
-                'mountpoint': '-', 'refer': '19K', 'used': '0', 'written': '19K',
-            }),
-            ('snap_p2', {
-                'name': 'pool@snap_p2',
-                'mountpoint': '-', 'refer': '19K', 'used': '0', 'written': '0',
-            }),
-        ]),
-        'pool/fs': OrderedDict([
-            ('snap_0', {
-                'name': 'pool/fs@snap_0',
-                'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M',
-            }),
-            ('snap_1_f', {
-                'name': 'pool/fs@snap_1_f',
-                'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M',
-            }),
-            ('funky_name', {
-                'name': 'pool/fs@funky_name',
-                'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M',
-            }),
-            ('snap_2', {
-                'name': 'pool/fs@snap_2',
-                'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M',
-            }),
-            ('snap_3', {
-                'name': 'pool/fs@snap_3',
-                'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M'
-            }),
-            ('snap_8', {
-                'name': 'pool/fs@snap_8',
-                'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M'
-            }),
-            ('snap_9', {
-                'name': 'pool/fs@snap_9',
-                'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M'
-            }),
-        ])
-    }
+    # _parse_snapshots only returns this filesystem's snapshots with the prefix,
+    # pool@ lines and funky_name are dropped
+    expected = OrderedDict([
+        ('snap_0', {
+            'name': 'pool/fs@snap_0',
+            'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M',
+        }),
+        ('snap_1_f', {
+            'name': 'pool/fs@snap_1_f',
+            'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M',
+        }),
+        ('snap_2', {
+            'name': 'pool/fs@snap_2',
+            'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M',
+        }),
+        ('snap_3', {
+            'name': 'pool/fs@snap_3',
+            'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M'
+        }),
+        ('snap_8', {
+            'name': 'pool/fs@snap_8',
+            'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M'
+        }),
+        ('snap_9', {
+            'name': 'pool/fs@snap_9',
+            'mountpoint': '-', 'refer': '10.0M', 'used': '10.0M', 'written': '10.0M'
+        }),
+    ])
     snapshots = zfs._parse_snapshots()
-    # comparing .items() because we care about the sorting in the OrderedDict's
-    assert snapshots['pool'].items() == expected['pool'].items()
-    assert snapshots['pool/fs'].items() == expected['pool/fs'].items()
+    # comparing .items() because we care about the sorting in the OrderedDict
+    assert snapshots.items() == expected.items()
 
 
 @pytest.mark.parametrize("fs_name, expected", [
@@ -254,6 +399,65 @@ def test_zfs_list(fs_name, expected):
     assert actual == expected
 
 
+def test_zfs_list_runs_once():
+    zfs = FakeZFSManager(fs_name='pool/fs', snapshot_prefix='snap_')
+    calls = []
+    list_snapshots = zfs._list_snapshots
+    zfs._list_snapshots = lambda: calls.append(1) or list_snapshots()
+    first = zfs._build_snapshots('pool/fs')
+    assert list(zfs._build_snapshots('pool/fs')) == list(first)
+    assert len(calls) == 1
+
+
+def test_stream_lines():
+    lines = _stream_lines([sys.executable, '-c', 'print("pool/fs@snap_0\\t10.0M"); print()'])
+    assert list(lines) == ['pool/fs@snap_0\t10.0M\n', '\n']
+    with pytest.raises(subprocess.CalledProcessError):
+        list(_stream_lines([sys.executable, '-c', 'import sys; sys.exit(2)']))
+
+
+def test_import_needs_no_aws_profile():
+    # zfs3backup_ssh_sync never talks to S3, importing it mustn't set up a boto3 session
+    env = dict(os.environ, PROFILE='zfs3backup-no-such-profile')
+    subprocess.check_call(
+        [sys.executable, '-c', 'import zfs3backup.ssh_sync, zfs3backup.snap'], env=env)
+
+
+def test_dataset_exists(monkeypatch):
+    calls = []
+
+    def stream_lines(cmd):
+        calls.append(cmd)
+        return iter(['pool\n', 'pool/fs\n', 'pool/fs/child\n'])
+    monkeypatch.setattr('zfs3backup.snap._stream_lines', stream_lines)
+    zfs = ZFSSnapshotManager(fs_name='pool/fs', snapshot_prefix='snap_')
+    assert zfs.datasets() == ['pool', 'pool/fs', 'pool/fs/child']
+    assert zfs.dataset_exists('pool/fs/child')
+    assert not zfs.dataset_exists('pool/other')
+    # one listing for datasets() and one shared by every dataset_exists call
+    assert calls == [['zfs', 'list', '-H', '-o', 'name']] * 2
+
+
+def test_command_executor_pipeline(capsys):
+    cmd = CommandExecutor()
+    upper = [sys.executable, '-c', 'import sys; sys.stdout.write(sys.stdin.read().upper())']
+    assert cmd.shell([['echo', 'pool/fs@snap 1'], upper], capture=True) == 'POOL/FS@SNAP 1\n'
+    assert cmd.shell(['echo spam | tr a-z A-Z', upper], capture=True) == 'SPAM\n'  # shell stage
+    cmd.shell([['echo', 'pool/fs@snap 1'], upper], dry_run=True)
+    assert capsys.readouterr().out == f"echo 'pool/fs@snap 1' | {' '.join(shlex.quote(a) for a in upper)}\n"
+    many_lines = [sys.executable, '-c', 'for i in range(100000): print(i)']
+    assert cmd.shell([many_lines], capture=True).splitlines()[-1] == '99999'
+    with pytest.raises(SystemExit):
+        cmd.shell([['echo', 'spam'], ['false']])
+    with pytest.raises(SystemExit):
+        cmd.shell([['echo', 'spam'], ['zfs3backup-no-such-command']])
+
+
+def _stages(command):
+    """Splits a shell style pipeline into the stages CommandExecutor runs"""
+    return [shlex.split(stage) for stage in command.split(' | ')]
+
+
 class FakeCommandExecutor(CommandExecutor):
     has_pv = False  # disable pv for consistent test output
 
@@ -297,6 +501,59 @@ def test_pair_list(pair_manager):
     assert names == expected
 
 
+def test_list_snapshots_output(monkeypatch, capsys):
+    monkeypatch.setattr('zfs3backup.snap.ZFSSnapshotManager', FakeZFSManager)
+    bucket = FakeBucket()
+    list_snapshots(bucket, s3_prefix=FakeBucket.rand_prefix, filesystem='pool/fs', snapshot_prefix='snap_')
+    lines = capsys.readouterr().out.splitlines()[2:]  # skip the "Checking backup status" line
+    rows = [[col.strip() for col in line.split(' | ')] for line in lines]
+    assert rows[0] == ["NAME", "PARENT", "TYPE", "HEALTH", "LOCAL STATE", "SIZE"]
+    assert [row[0] for row in rows[1:]] == [
+        'snap_0', 'snap_1_f', 'snap_2', 'snap_3', 'snap_4_mp', 'snap_5',
+        'snap_6_cycle', 'snap_7_cycle', 'snap_8', 'snap_9']
+    assert rows[5] == ['snap_4_mp', 'missing_parent', 'incremental', 'missing parent', 'missing', '']
+    assert rows[9] == ['snap_8', '-', 'missing', '-', 'ok', '']
+    # every column is aligned
+    assert len(set(len(line.rstrip().split(' | ')[0]) for line in lines)) == 1
+    assert len(set(line.index(' | ', line.index(' | ') + 1) for line in lines)) == 1
+
+
+def test_pair_list_overlaps_zfs_and_s3():
+    # each side waits for the other to have started, run one after the other they time out
+    zfs_started, heads_started = threading.Event(), threading.Event()
+
+    class SlowZFSManager(FakeZFSManager):
+        def _list_snapshots(self):
+            zfs_started.set()
+            assert heads_started.wait(5), "zfs list ran before the metadata HEADs"
+            return super(SlowZFSManager, self)._list_snapshots()
+
+    class SlowBucket(CountingBucket):
+        def Object(self, name):
+            if not name.endswith(S3SnapshotManager.MANIFEST):
+                heads_started.set()
+                assert zfs_started.wait(5), "the metadata HEADs ran before zfs list"
+            return super(SlowBucket, self).Object(name)
+
+    bucket = SlowBucket()
+    s3_manager = S3SnapshotManager(
+        bucket, s3_prefix=FakeBucket.rand_prefix, snapshot_prefix="pool/fs@snap_")
+    zfs_manager = SlowZFSManager(fs_name='pool/fs', snapshot_prefix='snap_')
+    pairs = PairManager(s3_manager, zfs_manager).list(prefetch_metadata=True)
+    assert len(pairs) == 10
+    assert len(bucket.client_heads) == len(FakeBucket.fake_data)  # prefetched
+
+
+def test_pair_list_fetches_no_metadata():
+    bucket = CountingBucket()
+    s3_manager = S3SnapshotManager(
+        bucket, s3_prefix=FakeBucket.rand_prefix, snapshot_prefix="pool/fs@snap_")
+    zfs_manager = FakeZFSManager(fs_name='pool/fs', snapshot_prefix='snap_')
+    pairs = PairManager(s3_manager, zfs_manager).list()
+    assert len(pairs) == 10
+    assert bucket.heads == []  # pairing goes by name, one listing and no HEAD per key
+
+
 def test_backup_latest_full(pair_manager):
     pair_manager.backup_full()
     expected = [
@@ -305,7 +562,7 @@ def test_backup_latest_full(pair_manager):
          "pput --quiet --estimated 1234 --meta size=1234 "
          "--meta isfull=true {}pool/fs@snap_9")]
     assert pair_manager._cmd._called_commands == [
-        e.format(FakeBucket.rand_prefix)
+        _stages(e.format(FakeBucket.rand_prefix))
         for e in expected]
 
 
@@ -317,7 +574,7 @@ def test_backup_full(pair_manager):
          "pput --quiet --estimated 1234 --meta size=1234 "
          "--meta isfull=true {}pool/fs@snap_3")]
     assert pair_manager._cmd._called_commands == [
-        e.format(FakeBucket.rand_prefix)
+        _stages(e.format(FakeBucket.rand_prefix))
         for e in expected]
 
 
@@ -335,7 +592,7 @@ def test_backup_incremental_latest(pair_manager):
          "pput --quiet --estimated 1234 --meta size=1234 "
          "--meta parent=pool/fs@snap_8 {}pool/fs@snap_9")
     ]
-    expected = [e.format(FakeBucket.rand_prefix) for e in commands]
+    expected = [_stages(e.format(FakeBucket.rand_prefix)) for e in commands]
     assert pair_manager._cmd._called_commands == expected
 
 
@@ -351,7 +608,7 @@ def test_backup_incremental_missing_parent(s3_manager):
     pair_manager = PairManager(s3_manager, zfs_manager, command_executor=fake_cmd)
     with pytest.raises(IntegrityError) as excp_info:
         pair_manager.backup_incremental()
-    assert excp_info.value.message == \
+    assert str(excp_info.value) == \
         "Broken snapshot detected pool/fs@snap_5, reason: 'parent broken'"
     assert fake_cmd._called_commands == []
 
@@ -372,7 +629,7 @@ def test_backup_incremental_cycle(s3_manager):
     pair_manager = PairManager(s3_manager, zfs_manager, command_executor=fake_cmd)
     with pytest.raises(IntegrityError) as excp_info:
         pair_manager.backup_incremental()
-    assert excp_info.value.message == \
+    assert str(excp_info.value) == \
         "Broken snapshot detected pool/fs@snap_7_cycle, reason: 'cycle detected'"
     assert fake_cmd._called_commands == []
 
@@ -396,7 +653,7 @@ def test_backup_incremental_compressed(s3_manager):
          "pput --quiet --estimated 1234 --meta size=1234 --meta parent=pool/fs@snap_3 "
          "--meta compressor=pigz1 {}pool/fs@snap_8"),
     ]
-    expected = [e.format(FakeBucket.rand_prefix) for e in commands]
+    expected = [_stages(e.format(FakeBucket.rand_prefix)) for e in commands]
     assert fake_cmd._called_commands == expected
 
 
@@ -419,7 +676,7 @@ def test_backup_full_compressed(s3_manager):
          "pput --quiet --estimated 1234 --meta size=1234 --meta isfull=true "
          "--meta compressor=pigz1 {}pool/fs@snap_8"),
     ]
-    expected = [e.format(FakeBucket.rand_prefix) for e in commands]
+    expected = [_stages(e.format(FakeBucket.rand_prefix)) for e in commands]
     assert fake_cmd._called_commands == expected
 
 
@@ -432,7 +689,7 @@ def test_restore_full(s3_manager):
     pair_manager.restore('pool/fs@snap_1_f')
     expected = "zfs3backup_get {}pool/fs@snap_1_f | pigz -d | zfs recv pool/fs@snap_1_f".format(
         FakeBucket.rand_prefix)
-    assert fake_cmd._called_commands == [expected]
+    assert fake_cmd._called_commands == [_stages(expected)]
 
 
 def test_restore_incremental_empty_dataset(s3_manager):
@@ -448,7 +705,7 @@ def test_restore_incremental_empty_dataset(s3_manager):
         "zfs3backup_get {}pool/fs@snap_2 | zfs recv pool/fs@snap_2",
         "zfs3backup_get {}pool/fs@snap_3 | zfs recv pool/fs@snap_3",
     ]
-    expected = [e.format(FakeBucket.rand_prefix) for e in expected]
+    expected = [_stages(e.format(FakeBucket.rand_prefix)) for e in expected]
     assert fake_cmd._called_commands == expected
 
 
@@ -467,7 +724,7 @@ def test_restore_incremental(s3_manager):
     expected = [
         "zfs3backup_get {}pool/fs@snap_3 | zfs recv pool/fs@snap_3",
     ]
-    expected = [e.format(FakeBucket.rand_prefix) for e in expected]
+    expected = [_stages(e.format(FakeBucket.rand_prefix)) for e in expected]
     assert fake_cmd._called_commands == expected
 
 
@@ -483,7 +740,7 @@ def test_restore_broken(s3_manager):
     pair_manager = PairManager(s3_manager, zfs_manager, command_executor=fake_cmd)
     with pytest.raises(IntegrityError) as excp_info:
         pair_manager.restore('pool/fs@snap_4_mp')
-    assert excp_info.value.message == \
+    assert str(excp_info.value) == \
         "Broken snapshot detected pool/fs@snap_4_mp, reason: 'missing parent'"
 
 
@@ -516,7 +773,7 @@ def test_restore_force(s3_manager):
     expected = [
         "zfs3backup_get {}pool/fs@snap_3 | zfs recv -F pool/fs@snap_3",
     ]
-    expected = [e.format(FakeBucket.rand_prefix) for e in expected]
+    expected = [_stages(e.format(FakeBucket.rand_prefix)) for e in expected]
     assert fake_cmd._called_commands == expected
 
 
@@ -528,9 +785,9 @@ def test_get_latest():
     fake_cmd = FakeCommandExecutor()
     with pytest.raises(SoftError) as excp_info:
         zfs_manager.get_latest()
-    assert excp_info.value.message == \
-        'Nothing to backup for filesystem "None". Are you sure ' \
-        'SNAPSHOT_PREFIX="zfs-auto-snap:daily" is correct?'
+    assert str(excp_info.value) == \
+        'Nothing to backup for filesystem "pool/fs". Are you sure ' \
+        'SNAPSHOT_PREFIX="snap_" is correct?'
     assert fake_cmd._called_commands == []
 
 
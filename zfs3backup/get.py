@@ -1,18 +1,34 @@
 import argparse
+import os
 import sys
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 from zfs3backup.config import get_config
 
 
+MEGA = 1024 * 1024
+# ranged gets run in parallel; the output is a pipe so parts are written out in order
+TRANSFER_CONFIG = TransferConfig(
+    multipart_chunksize=16 * MEGA,
+    max_concurrency=(os.cpu_count() or 1) * 2,
+    use_threads=True,
+)
+# hand zfs recv large writes instead of one small write per downloaded block
+STDOUT_BUFFER_SIZE = 8 * MEGA
+
+
 def download(bucket, name):
+    with open(sys.stdout.fileno(), 'wb', buffering=STDOUT_BUFFER_SIZE, closefd=False) as out:
+        try:
+            bucket.download_fileobj(name, out, Config=TRANSFER_CONFIG)
+        except Exception as ex:
+            print("Boto3 download_fileobj call failed", file=sys.stderr)
+            print(ex, file=sys.stderr)  # stdout is the data stream, keep errors out of it
+            # a non zero status is the only way zfs recv's caller learns the stream is truncated
+            sys.exit(1)
 
-	try:
-		bucket.download_fileobj(name, sys.stdout.buffer)
-	except Exception as ex:
-		print("Boto3 download_fileobj call failed",file=sys.stderr)
-		print(ex)
-    
 
 def main():
     cfg = get_config()
@@ -22,10 +38,13 @@ def main():
     parser.add_argument('name', help='name of S3 key')
     args = parser.parse_args()
 
+    # one pooled connection per download thread
+    config = Config(max_pool_connections=TRANSFER_CONFIG.max_concurrency)
     if cfg['ENDPOINT']== 'aws':   # boto3.resource makes an intelligent decision with the default url
-        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource('s3')
+        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource('s3', config=config)
     else:
-        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource('s3',endpoint_url=cfg['ENDPOINT'])
+        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource(
+            's3', endpoint_url=cfg['ENDPOINT'], config=config)
 
     bucket = s3.Bucket(cfg['BUCKET'])
 
@@ -4,22 +4,28 @@ usage
 pput bucket_name/filename
 """
 
-from queue import Queue
+from queue import Empty, Queue
 from io import StringIO
 from collections import namedtuple
-from threading import Thread
+from threading import Event, Lock, Thread
 import argparse
-import base64
 import binascii
+import fcntl
 import functools
 import hashlib
 import logging
 import json
 import os
+import random
+import stat
 import sys
+import time
 
 import boto3
+from botocore.compat import HAS_CRT
 from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
 
 # Create a custom configuration required for Boto > 1.36 on Wasabi
 no_check_config = Config(
@@ -29,36 +35,82 @@ no_check_config = Config(
 
 
 from zfs3backup.config import get_config
+from zfs3backup.signing import SIGNS_PAYLOAD, slow_sha256_warning
 
 
-Result = namedtuple('Result', ['success', 'traceback', 'index', 'md5', 'etag'])
+# size and elapsed (seconds spent uploading the part) are only used to tune the chunk size
+# checksum is the part's CRC32C as returned by S3, when uploading with --checksum crc32c
+Result = namedtuple('Result', ['success', 'traceback', 'index', 'md5', 'etag', 'size', 'elapsed',
+                               'checksum'],
+                    defaults=(None, None, None))
+# pooled chunk data goes back to pool once uploaded
+Chunk = namedtuple('Chunk', ['data', 'pool'], defaults=(None,))
 CFG = get_config()
 VERB_QUIET = 0
 VERB_NORMAL = 1
 VERB_PROGRESS = 2
+# linux pipes hold 64K by default, so reading a chunk from `zfs send | pput` takes one
+# read syscall (and one context switch with the writer) per 64K
+PIPE_BUFFER_SIZE = 1024 * 1024  # the default /proc/sys/fs/pipe-max-size for unprivileged users
+MAX_PARTS = 9999  # S3 requires part indexes to be between 1 and 10000
+MIN_PART_SIZE = 5 * 1024 * 1024  # every part but the last has to be at least 5MB
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+# How parts are checked on the way in:
+# md5: a Content-MD5 header, costs a full md5 pass over every part; other providers
+#     (e.g. Wasabi) may insist on it
+# crc32c: S3 verifies a CRC32C, far cheaper with the SSE4.2 instruction but botocore only
+#     computes it through awscrt (pip install botocore[crt])
+# none: rely on TLS, the per-part ETags S3 returns are still the md5 of what it stored
+CHECKSUMS = ('none', 'md5', 'crc32c')
+
+
+def _default_checksum():
+    if 'SEND_CONTENT_MD5' in CFG:  # the setting --checksum replaced
+        return 'md5' if CFG['SEND_CONTENT_MD5'].lower() == 'true' else 'none'
+    if CFG['ENDPOINT'] != 'aws':
+        return 'md5'
+    return 'crc32c' if HAS_CRT else 'none'
+
+
+CHECKSUM = CFG.get('CHECKSUM', _default_checksum()).lower()
 #print(f"here we print the Endpoint to check {cfg['ENDPOINT']}")
 session=boto3.Session(profile_name=CFG['PROFILE'])
-if CFG['ENDPOINT'] == 'aws':   # boto3.resource makes an intelligent decision with the default url
-    s3 = session.resource('s3', config=no_check_config)
-else:
-    s3 = session.resource('s3', endpoint_url=CFG['ENDPOINT'],config=no_check_config)
+
+
+def get_s3(concurrency=int(CFG['CONCURRENCY']), checksum=CHECKSUM):
+    """Returns an s3 resource whose connection pool has room for one connection per
+    upload worker. botocore only keeps 10 connections alive by default, with more workers
+    than that parts keep paying a fresh TCP+TLS handshake instead of reusing a socket.
+    """
+    config = no_check_config.merge(Config(max_pool_connections=concurrency))
+    if checksum != 'md5' and not SIGNS_PAYLOAD:
+        # without a Content-MD5 header botocore falls back to SHA256 signing the whole
+        # body, trading one hash pass for a slower one; over https it's not needed
+        config = config.merge(Config(s3={'payload_signing_enabled': False}))
+    if CFG['ENDPOINT'] == 'aws':   # boto3.resource makes an intelligent decision with the default url
+        return session.resource('s3', config=config)
+    return session.resource('s3', endpoint_url=CFG['ENDPOINT'], config=config)
+
+
+s3 = get_s3()
+
+# MD5 is only used for integrity checks; usedforsecurity=False keeps it on the OpenSSL
+# fast path instead of being rejected or shimmed on FIPS enabled builds
+_md5 = functools.partial(hashlib.md5, usedforsecurity=False)
 
 
 def multipart_etag(digests):
     """
     Computes etag for multipart uploads
-    :type digests: list of hex-encoded md5 sums (string)
+    :type digests: list of raw md5 digests (bytes)
     :param digests: The list of digests for each individual chunk.
 
     :rtype: string
     :returns: The etag computed from the individual chunks.
     """
-    etag = hashlib.md5()
-    count = 0
-    for dig in digests:
-        count += 1
-        etag.update(binascii.a2b_hex(dig))
-    return f"'{etag.hexdigest()}-{count}'"
+    digests = b''.join(digests)
+    etag = _md5(digests)
+    return f'"{etag.hexdigest()}-{len(digests) // etag.digest_size}"'
 
 
 def parse_size(size):
@@ -77,43 +129,144 @@ def parse_size(size):
     return int(size)
 
 
+def grow_pipe_buffer(stream, size=PIPE_BUFFER_SIZE):
+    """If stream is a pipe, ask the kernel to enlarge its buffer so each read returns
+    up to `size` bytes. The pipe is shared with the writer so both ends benefit.
+    Best effort, the pipe is left alone if it can't be resized.
+    """
+    if not hasattr(fcntl, 'F_SETPIPE_SZ'):  # linux only
+        return
+    try:
+        fileno = stream.fileno()
+        if stat.S_ISFIFO(os.fstat(fileno).st_mode):
+            fcntl.fcntl(fileno, fcntl.F_SETPIPE_SZ, size)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+class BufferPool(object):
+    """Up to `count` chunk buffers, reused once their chunk is uploaded instead of
+    allocating (and page faulting) a fresh multi MB bytearray for every chunk.
+    acquire hands out a buffer of exactly the requested size, so memory follows the
+    chunk sizes actually in use: a free buffer is trimmed in place when the chunk size
+    drops and replaced when it grows. acquire blocks while all `count` buffers are in use.
+    """
+    def __init__(self, count):
+        self._count = count
+        self._created = 0
+        self._free = Queue()
+
+    def acquire(self, size):
+        # only the reader acquires buffers so _created needs no lock
+        try:
+            buf = self._free.get_nowait()
+        except Empty:
+            if self._created < self._count:
+                self._created += 1
+                return bytearray(size)
+            buf = self._free.get()
+        if len(buf) < size:
+            return bytearray(size)  # the old buffer is freed rather than kept alongside
+        del buf[size:]
+        return buf
+
+    def release(self, buf):
+        self._free.put(buf)
+
+
 class StreamHandler(object):
-    def __init__(self, input_stream, chunk_size=5*1024*1024):
+    def __init__(self, input_stream, chunk_size=5*1024*1024, pool=None):
+        """chunk_size is either a fixed size or a callable returning the size of the next chunk
+        pool is an optional BufferPool to take the chunk buffers from
+        """
         self.input_stream = input_stream
         self.chunk_size = chunk_size
-        self._partial_chunk = b""
+        self._pool = pool
+        # chunks are assembled in place with readinto, growing a bytes object with +=
+        # copies everything read so far on every read
+        self._buf = None  # taken when the next chunk starts, never after EOF
+        self._size = 0
+        self._filled = 0
         self._eof_reached = False
 
     @property
     def finished(self):
-        return self._eof_reached and len(self._partial_chunk) == 0
+        return self._eof_reached and self._filled == 0
 
     def get_chunk(self):
         """Return complete chunks or None if EOF reached"""
         while not self._eof_reached:
-            read = self.input_stream.read(self.chunk_size - len(self._partial_chunk))
-            if len(read) == 0:
-                self._eof_reached = True
-            self._partial_chunk += read
-            if len(self._partial_chunk) == self.chunk_size or self._eof_reached:
-                chunk = self._partial_chunk
-                self._partial_chunk = b""
-                return chunk
-            # else:
-            #     print "partial", len(self._partial_chunk)
-
-
-def retry(times=int(CFG['MAX_RETRIES'])):
+            if self._buf is None:
+                self._new_buffer()
+            with memoryview(self._buf) as view:
+                read = self.input_stream.readinto(view[self._filled:self._size])
+                if not read:
+                    self._eof_reached = True
+                else:
+                    self._filled += read
+            if self._filled == self._size or (self._eof_reached and self._filled):
+                return self._hand_off()
+        if self._buf is not None:
+            # the stream ended right after a complete chunk, the new buffer was never used
+            if self._pool is not None:
+                self._pool.release(self._buf)
+            self._buf = None
+
+    def _next_chunk_size(self):
+        if callable(self.chunk_size):
+            return self.chunk_size()
+        return self.chunk_size
+
+    def _new_buffer(self):
+        self._size = self._next_chunk_size()
+        if self._pool is not None:
+            self._buf = self._pool.acquire(self._size)
+        else:
+            self._buf = bytearray(self._size)
+
+    def _hand_off(self):
+        """Give the filled buffer away as the chunk data, without copying it."""
+        buf, filled = self._buf, self._filled
+        self._buf = None
+        self._filled = 0
+        if filled < len(buf):
+            del buf[filled:]  # shrinks in place, only happens for the last chunk
+        return Chunk(data=buf, pool=self._pool)
+
+
+# S3 error codes worth retrying, anything else (AccessDenied, NoSuchBucket, InvalidDigest...)
+# won't get any better by sending the same request again
+RETRIABLE_ERROR_CODES = frozenset([
+    'SlowDown', 'RequestTimeout', 'InternalError', 'ServiceUnavailable',
+    'Throttling', 'ThrottlingException', 'RequestLimitExceeded', '500', '503',
+])
+
+
+def is_retriable(excp):
+    """True for throttling, server side and connection errors"""
+    if isinstance(excp, ClientError):
+        code = excp.response.get('Error', {}).get('Code')
+        status = excp.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return code in RETRIABLE_ERROR_CODES or status >= 500
+    return isinstance(excp, (HTTPClientError, BotoConnectionError, ConnectionError, UploadException))
+
+
+def retry(times=int(CFG['MAX_RETRIES']), retriable=is_retriable, base_delay=1, max_delay=30):
+    """Retries transient failures with jittered exponential backoff, so a throttled
+    endpoint isn't hammered with immediate retries. Other errors are raised right away.
+    """
     def decorator(func):
         @functools.wraps(func)
         def wrapped(*a, **kwa):
             for attempt in range(1, times+1):
                 try:
                     return func(*a, **kwa)
-                except:  # pylint: disable=bare-except
-                    if attempt >= times:
+                except Exception as excp:  # pylint: disable=broad-except
+                    if attempt >= times or not retriable(excp):
                         raise
                     logging.exception(f"Failed to upload part attempt {attempt} of {times}")
+                    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+                    time.sleep(delay * random.uniform(0.5, 1))
         return wrapped
     return decorator
 
@@ -123,30 +276,47 @@ class WorkerCrashed(Exception):
 
 
 class UploadWorker(object):
-    def __init__(self, bucket, multipart, inbox, outbox):
+    def __init__(self, bucket, multipart, inbox, outbox, checksum=CHECKSUM):
         self.bucket = bucket
         self.inbox = inbox
         self.outbox = outbox
         self.multipart = multipart
+        # resolve everything upload_part needs once, building a MultipartUploadPart
+        # resource per part goes through boto3's resource factory every time
+        self.bucket_name = multipart.bucket_name
+        self.key = multipart.object_key
+        self.upload_id = multipart.id
+        self.checksum = checksum
+        self._client = s3.meta.client
         self._thread = None
         self.log = logging.getLogger('UploadWorker')
 
     @retry()
     def upload_part(self, index, chunk):
-        md5 = hashlib.md5(chunk)
-        part = s3.MultipartUploadPart(
-            self.multipart.bucket_name,
-            self.multipart.object_key,
-            self.multipart.id,
-            index
-            )
-        response = part.upload(
-            Body = chunk,
-            ContentMD5 = base64.b64encode(md5.digest()).decode()
-            )
+        # pass the bytearray as is with an explicit length so botocore sends it
+        # straight to the socket instead of copying or sniffing its size
+        params = dict(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            PartNumber=index,
+            UploadId=self.upload_id,
+            Body=chunk.data,
+            ContentLength=len(chunk.data),
+        )
+        if self.checksum == 'md5':
+            # hashed here rather than by the reader so md5 runs on all the workers' cores
+            # at once, hashlib releases the GIL for buffers this size
+            md5_bin = _md5(chunk.data).digest()
+            params['ContentMD5'] = binascii.b2a_base64(md5_bin, newline=False).decode()
+        elif self.checksum == 'crc32c':
+            params['ChecksumAlgorithm'] = 'CRC32C'  # computed by botocore, verified by S3
+        response = self._client.upload_part(**params)
         if response['ResponseMetadata']['HTTPStatusCode'] != 200:
             raise UploadException(response['ResponseMetadata'])
-        return md5.hexdigest(), response[u'ETag']
+        if self.checksum != 'md5':
+            # the ETag of a part is the md5 of the data S3 received
+            md5_bin = binascii.a2b_hex(response[u'ETag'].strip('"'))
+        return md5_bin, response[u'ETag'], response.get('ChecksumCRC32C')
 
     def start(self):
         self._thread = Thread(target=self.main_loop)
@@ -154,19 +324,32 @@ class UploadWorker(object):
         self._thread.start()
         return self
 
-    def is_alive(self):
-        return self._thread.is_alive()
-
     def main_loop(self):
         while True:
             index, chunk = self.inbox.get()
-            md5, etag = self.upload_part(index, chunk)
+            size = len(chunk.data)
+            started = time.monotonic()
+            try:
+                md5, etag, checksum = self.upload_part(index, chunk)
+            except Exception as excp:  # pylint: disable=broad-except
+                # report the failure instead of dying silently, the supervisor blocks
+                # on the outbox and would otherwise never notice
+                self.log.exception(f"Failed to upload part {index}")
+                self.outbox.put(Result(success=False, traceback=excp, index=index, md5=None, etag=None))
+                return
+            finally:
+                if chunk.pool is not None:
+                    chunk.pool.release(chunk.data)  # done with it, retries included
+            del chunk  # don't hold on to the chunk's buffer while waiting for the next one
             self.outbox.put(Result(
                 success=True,
                 md5=md5,
                 traceback=None,
                 index=index,
-                etag=etag
+                etag=etag,
+                size=size,
+                elapsed=time.monotonic() - started,
+                checksum=checksum,
             ))
 
 
@@ -177,19 +360,37 @@ class UploadException(Exception):
 class UploadSupervisor(object):
     '''Reads chunks and dispatches them to UploadWorkers'''
 
-    def __init__(self, stream_handler, name, bucket, headers=None, metadata=None, verbosity=1):
+    # adaptive chunk sizing; aim for parts that take this long to upload so the per-request
+    # round trip is amortized, once this many parts have been timed
+    target_part_seconds = 10
+    min_samples = 4
+    max_chunk_growth = 4  # bounds memory use to max_chunk_growth * chunk_size per worker
+
+    def __init__(self, stream_handler, name, bucket, headers=None, metadata=None, verbosity=1,
+                 estimated=None, checksum=CHECKSUM):
         self.stream_handler = stream_handler
         self.name = name
         self.bucket = bucket
         self.inbox = None
         self.outbox = None
         self.multipart = None
-        self.results = []  # beware s3 multipart indexes are 1 based
+        # (md5, etag, checksum) stored at index - 1, beware s3 multipart indexes are 1 based
+        self.results = []
         self._pending_chunks = 0
+        self._pending_lock = Lock()
+        self._reader_done = Event()
+        self._reader_error = None
+        self._estimated = estimated
+        self._base_chunk_size = None
+        self._sent_parts = 0
+        self._sent_bytes = 0
+        self._samples = 0
+        self._throughput_ewma = None  # bytes/s uploaded by a single worker
         self._verbosity = verbosity
         self._workers = None
         self._headers = {} if headers is None else headers
         self._metadata = {} if metadata is None else metadata
+        self._checksum = checksum
         self.obj = None
 
     def _start_workers(self, concurrency, worker_class):
@@ -203,6 +404,7 @@ class UploadSupervisor(object):
                 multipart=self.multipart,
                 inbox=work_queue,
                 outbox=result_queue,
+                checksum=self._checksum,
             ).start()
             for _ in range(concurrency)]
         return workers
@@ -212,78 +414,139 @@ class UploadSupervisor(object):
             raise AssertionError("multipart upload already started")
 
         self.obj = self.bucket.Object(self.name)
+        headers = dict(self._headers)
+        if self._checksum == 'crc32c':
+            headers['ChecksumAlgorithm'] = 'CRC32C'  # every part then has to carry one
         self.multipart = self.obj.initiate_multipart_upload(
             ACL="bucket-owner-full-control",
             Metadata=self._metadata,
-            **self._headers
+            **headers
             )
 
     def _finish_upload(self):
         if len(self.results) == 0:
             self.multipart.abort()
             raise UploadException("Error: Can't upload zero bytes!")
-        sorted_results = sorted(
-            [{'PartNumber': r[0], 'ETag': r[2]} for r in self.results],
-            key = lambda x: x['PartNumber']
-            )
+        parts = []
+        for i, result in enumerate(self.results):
+            if not result:
+                continue
+            _, etag, checksum = result
+            part = {'PartNumber': i + 1, 'ETag': etag}
+            if checksum is not None:
+                part['ChecksumCRC32C'] = checksum
+            parts.append(part)
         return self.multipart.complete(
                 MultipartUpload={
-                    'Parts': sorted_results
+                    'Parts': parts
                 }
             )
 
-    def _handle_result(self):
-        """Process one result. Block untill one is available
+    def _handle_result(self, timeout=None):
+        """Process one result. Block untill one is available or timeout expires
         """
-        result = self.inbox.get()
+        try:
+            result = self.inbox.get(timeout=timeout)
+        except Empty:
+            return
+        if result is None:
+            return  # the reader finished, wake up and re-check _done
         if result.success:
             if self._verbosity >= VERB_PROGRESS:
                 sys.stderr.write(f"\nuploaded chunk {result.index} \n")
-            self.results.append((result.index, result.md5, result.etag))
-            self._pending_chunks -= 1
+            # results arrive out of order, store them in their slot so they never need sorting
+            if result.index > len(self.results):
+                self.results.extend([None] * (result.index - len(self.results)))
+            self.results[result.index - 1] = (result.md5, result.etag, result.checksum)
+            if result.elapsed:
+                self._update_throughput(result.size / result.elapsed)
+            with self._pending_lock:
+                self._pending_chunks -= 1
         else:
-            raise result.traceback
-
-    def _handle_results(self):
-        """Process any available result
-        Doesn't block.
-        """
-        while not self.inbox.empty():
-            self._handle_result()
+            raise WorkerCrashed(f"upload of part {result.index} failed: {result.traceback}") \
+                from result.traceback
 
     def _send_chunk(self, index, chunk):
-        """Send the current chunk to the workers for processing.
-        Called when the _partial_chunk is complete.
+        """Send a Chunk the reader thread got from the stream handler to the workers.
 
         Blocks when the outbox is full.
         """
-        self._pending_chunks += 1
+        with self._pending_lock:
+            self._pending_chunks += 1
+        self._sent_parts = index
+        self._sent_bytes += len(chunk.data)
         self.outbox.put((index, chunk))
 
-    def _check_workers(self):
-        """Check workers are alive, raise exception if any is dead."""
-        for worker in self._workers:
-            if not worker.is_alive():
-                raise WorkerCrashed()
+    def _update_throughput(self, throughput, alpha=0.3):
+        self._samples += 1
+        if self._throughput_ewma is None:
+            self._throughput_ewma = throughput
+        else:
+            self._throughput_ewma = alpha * throughput + (1 - alpha) * self._throughput_ewma
 
-    def main_loop(self, concurrency=4, worker_class=UploadWorker):
+    def dynamic_chunk_size(self):
+        """Size of the next chunk, tuned to the measured per worker upload throughput.
+        Never smaller than what's needed to fit the rest of the estimated upload in
+        the parts S3 has left, and never more than max_chunk_growth times the initial size.
+        """
+        ceiling = min(self._base_chunk_size * self.max_chunk_growth, MAX_PART_SIZE)
+        remaining = self._estimated * 1.05 - self._sent_bytes  # same safety margin as optimize_chunksize
+        parts_left = MAX_PARTS - self._sent_parts - 1  # keep one for the part in flight
+        if remaining <= 0 or parts_left <= 0:
+            return ceiling  # the estimate was off, make the most of the parts we have left
+        floor = max(MIN_PART_SIZE, remaining / parts_left)
+        if self._samples < self.min_samples:
+            return int(min(max(floor, self._base_chunk_size), ceiling))
+        wanted = self._throughput_ewma * self.target_part_seconds
+        return int(min(max(wanted, floor), ceiling))
+
+    def _reader_loop(self):
+        """Reads chunks from the stream handler and sends them to the workers.
+        Runs on its own thread so reading the next chunk overlaps with uploading
+        the previous ones; the bounded outbox keeps it at most `concurrency` chunks ahead.
+        """
         chunk_index = 0
+        try:
+            while not self.stream_handler.finished:
+                chunk = self.stream_handler.get_chunk()
+                if chunk is not None:
+                    # s3 multipart index is 1 based, increment before sending
+                    chunk_index += 1
+                    self._send_chunk(chunk_index, chunk)
+        except Exception as excp:  # pylint: disable=broad-except
+            self._reader_error = excp
+        finally:
+            self._reader_done.set()
+            self.inbox.put(None)  # wake up the supervisor in case nothing is pending
+
+    def _check_reader(self):
+        """Re-raise any exception the reader thread died with."""
+        if self._reader_error is not None:
+            raise self._reader_error
+
+    @property
+    def _done(self):
+        # check the reader first, once it's done _pending_chunks can only go down
+        return self._reader_done.is_set() and self._pending_chunks == 0
+
+    def main_loop(self, concurrency=4, worker_class=UploadWorker):
+        if self._estimated is not None:
+            # we know roughly how much data is coming, let the measured throughput pick chunk sizes
+            self._base_chunk_size = self.stream_handler.chunk_size
+            self.stream_handler.chunk_size = self.dynamic_chunk_size
         self._begin_upload()
         self._workers = self._start_workers(concurrency, worker_class=worker_class)
-        while self._pending_chunks or not self.stream_handler.finished:
-            self._check_workers()  # raise exception and stop everything if any worker has crashed
-            # print "main_loop p:{} o:{} i:{}".format(
-            #     self._pending_chunks, self.outbox.qsize(), self.inbox.qsize())
-            # consume results first as this is a quick operation
-            self._handle_results()
-            chunk = self.stream_handler.get_chunk()
-            if chunk:
-                # s3 multipart index is 1 based, increment before sending
-                chunk_index += 1
-                self._send_chunk(chunk_index, chunk)
+        reader = Thread(target=self._reader_loop)
+        reader.daemon = True
+        reader.start()
+        # workers report failures and the reader posts a wake up when it's done,
+        # so block on the results instead of polling
+        while not self._done:
+            self._handle_result()
+            self._check_reader()
+        self._check_reader()
         self._finish_upload()
-        self.results.sort()
-        return multipart_etag(r[1] for r in self.results)
+        return multipart_etag(r[0] for r in self.results)
 
 
 def parse_metadata(metadata):
@@ -299,10 +562,9 @@ def parse_metadata(metadata):
 
 
 def optimize_chunksize(estimated):
-    max_parts = 9999  # S3 requires part indexes to be between 1 and 10000
     # part size has to be at least 5MB  (BK I tried this up to 10MB and dropped the concurrency)
     estimated = estimated * 1.05  # just to be on the safe side overesimate the total size to upload
-    min_part_size = max(estimated / max_parts, 10*1024*1024)
+    min_part_size = max(estimated / MAX_PARTS, 10*1024*1024)
     return int(min_part_size)
 
 
@@ -333,6 +595,11 @@ def parse_args():
                         type=int,
                         default=int(CFG['CONCURRENCY']),
                         help='number of worker threads to use')
+    parser.add_argument('--checksum',
+                        choices=CHECKSUMS,
+                        default=CHECKSUM,
+                        help=('how S3 checks each part, md5 sends Content-MD5, crc32c needs awscrt; '
+                              'defaults to crc32c on aws if available and md5 elsewhere'))
     parser.add_argument('--metadata',
                         action='append',
                         dest='metadata',
@@ -353,13 +620,24 @@ def parse_args():
 
 
 def main():
+    global s3  # pylint: disable=global-statement
     args = parse_args()
-    input_fd = fopen(args.file_descriptor, mode='rb') if args.file_descriptor else sys.stdin.buffer
+    if args.checksum == 'crc32c' and not HAS_CRT:
+        sys.stderr.write("--checksum crc32c needs awscrt, pip install botocore[crt]\n")
+        return 1
+    if args.concurrency > int(CFG['CONCURRENCY']) or args.checksum != CHECKSUM:
+        s3 = get_s3(max(args.concurrency, int(CFG['CONCURRENCY'])), args.checksum)
+    input_fd = os.fdopen(args.file_descriptor, mode='rb') if args.file_descriptor else sys.stdin.buffer
+    grow_pipe_buffer(input_fd)
+    estimated = None
     if args.estimated is not None:
-        chunk_size = optimize_chunksize(parse_size(args.estimated))
+        estimated = parse_size(args.estimated)
+        chunk_size = optimize_chunksize(estimated)
     else:
         chunk_size = parse_size(args.chunk_size)
-    stream_handler = StreamHandler(input_fd, chunk_size=chunk_size)
+    # one buffer per worker, one per chunk waiting in the outbox and the one being filled
+    pool = BufferPool(2 * args.concurrency + 1)
+    stream_handler = StreamHandler(input_fd, chunk_size=chunk_size, pool=pool)
 
     bucket = s3.Bucket(CFG['BUCKET'])
 
@@ -374,8 +652,14 @@ def main():
         bucket=bucket,
         verbosity=verbosity,
         headers=headers,
-        metadata=metadata
+        metadata=metadata,
+        estimated=estimated,
+        checksum=args.checksum,
     )
+    if verbosity >= VERB_NORMAL:
+        warning = slow_sha256_warning()
+        if warning is not None:
+            sys.stderr.write(f"{warning}\n")
     if verbosity >= VERB_NORMAL:
         sys.stderr.write(f"starting upload to {CFG['BUCKET']}/{args.name} with chunksize"
                          f" {(chunk_size/(1024*1024.0))}M using {args.concurrency} workers\n")
@@ -1,23 +1,38 @@
 import argparse
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-import boto
+import boto3
+from botocore.config import Config
 
 from zfs3backup.config import get_config
 
 
-def cleanup_multipart(bucket, max_days=1, dry_run=False):
-    max_age_seconds = max_days * 24 * 3600
-    now = datetime.utcnow()
+# aborts are independent round trips, so run them concurrently instead of one at a time
+ABORT_CONCURRENCY = 16
+
+
+def cleanup_multipart(client, bucket, max_days=1, dry_run=False):
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_days)
+    expired = []
     print(f"{'A'} | {'key':30} | {'initiated':20}")
-    for multi in bucket.list_multipart_uploads():
-        delta = now-boto.utils.parse_ts(multi.initiated)
-        if delta.total_seconds() >= max_age_seconds:
-            print(f"{'X'} | {multi.key_name:30} | {multi.initiated:20}")
-            if not dry_run:
-                multi.cancel_upload()
-        else:
-            print(f"{' '} | {multi.key_name:30} | {multi.initiated:20}")
+    paginator = client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket):
+        for upload in page.get('Uploads', []):
+            initiated = upload['Initiated']  # already a timezone aware datetime
+            if initiated <= cutoff:
+                print(f"{'X'} | {upload['Key']:30} | {initiated.isoformat():20}")
+                expired.append(upload)
+            else:
+                print(f"{' '} | {upload['Key']:30} | {initiated.isoformat():20}")
+    if dry_run or not expired:
+        return
+    with ThreadPoolExecutor(max_workers=ABORT_CONCURRENCY) as pool:
+        # list() makes sure any failed abort is raised here
+        list(pool.map(
+            lambda upload: client.abort_multipart_upload(
+                Bucket=bucket, Key=upload['Key'], UploadId=upload['UploadId']),
+            expired))
 
 
 def main():
@@ -35,10 +50,15 @@ def main():
                         action='store_true',
                         help='Don\'t cancel any upload')
     args = parser.parse_args()
-    bucket = boto.connect_s3(
-        cfg['S3_KEY_ID'], cfg['S3_SECRET']).get_bucket(cfg['BUCKET'])
+    config = Config(max_pool_connections=ABORT_CONCURRENCY)
+    session = boto3.Session(profile_name=cfg['PROFILE'])
+    if cfg['ENDPOINT'] == 'aws':   # boto3.client makes an intelligent decision with the default url
+        client = session.client('s3', config=config)
+    else:
+        client = session.client('s3', endpoint_url=cfg['ENDPOINT'], config=config)
     cleanup_multipart(
-        bucket,
+        client,
+        cfg['BUCKET'],
         max_days=args.max_days,
         dry_run=args.dry_run,
     )
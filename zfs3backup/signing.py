@@ -0,0 +1,40 @@
+"""Checks on the cost of SHA256 payload signing.
+
+Kept apart from pput, which sets up a boto3 session on import, so zfs3backup
+can warn about slow signing without needing AWS credentials to start.
+"""
+
+import hashlib
+import ssl
+import time
+
+from zfs3backup.config import get_config
+
+
+# botocore only SHA256 signs part bodies on plain http, over https they're sent UNSIGNED-PAYLOAD
+SIGNS_PAYLOAD = get_config()['ENDPOINT'].startswith('http://')
+# OpenSSL builds using the CPU's SHA extensions hash several GB/s, generic builds
+# a few hundred MB/s which is enough to become the bottleneck on a fast link
+MIN_SHA256_THROUGHPUT = 1024 * 1024 * 1024
+
+
+def sha256_throughput(sample_size=8 * 1024 * 1024):
+    """Times one SHA256 pass over sample_size bytes, returns bytes/s."""
+    data = bytes(sample_size)
+    started = time.perf_counter()
+    hashlib.sha256(data).digest()
+    return sample_size / max(time.perf_counter() - started, 1e-9)
+
+
+def slow_sha256_warning():
+    """Returns a warning if parts get SHA256 signed on a machine where that's slow, else None.
+    Used by pput and by zfs3backup, which always runs pput --quiet.
+    """
+    if not SIGNS_PAYLOAD:
+        return None
+    throughput = sha256_throughput()
+    if throughput >= MIN_SHA256_THROUGHPUT:
+        return None
+    return (f"warning: SHA256 runs at {throughput/(1024*1024.0):.0f}MB/s with "
+            f"{ssl.OPENSSL_VERSION}, payload signing may limit the upload rate; "
+            "use an https endpoint or an OpenSSL build with SHA extensions")
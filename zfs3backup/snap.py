@@ -2,31 +2,28 @@ from __future__ import print_function
 
 import argparse
 import functools
+import json
 import logging
 import operator
 import os
+import shlex
 import subprocess
 import sys
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 from zfs3backup.config import get_config
+from zfs3backup.signing import slow_sha256_warning
 
 
-def cached(func):
-    @functools.wraps(func)
-    def cacheing_wrapper(self, *a, **kwa):
-        cache_key = func.__name__ + '_cached_value'
-        if len(a) or len(kwa):
-            # make sure we don't shoot ourselves in the foot by calling this on a method with args
-            raise AssertionError("'cached' decorator called on method with arguments!")
-        if not hasattr(self, cache_key):
-            val = func(self, *a, **kwa)
-            setattr(self, cache_key, val)
-        return getattr(self, cache_key)
-    return cacheing_wrapper
-
+# metadata HEADs are latency bound, also the size of the S3 connection pool
+METADATA_CONCURRENCY = 32
+# how much of a captured command's output is kept, zfs send -nvP prints a line per snapshot
+CAPTURE_TAIL_LINES = 100
 
 COMPRESSORS = {
     'pigz1': {
@@ -62,54 +59,49 @@ class S3Snapshot(object):
     MISSING_PARENT = 'missing parent'
     PARENT_BROKEN = 'parent broken'
 
-    def __init__(self, name, metadata, manager, size):
+    def __init__(self, name, metadata, manager, size, etag=None):
+        """metadata may be None, it's then fetched from S3 the first time it's needed"""
         self.name = name
+        self.etag = etag
         self._metadata = metadata
         self._mgr = manager
+        self._healthy = None  # set by S3SnapshotManager._classify_health
         self._reason_broken = None
         self.size = size
 
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = self._mgr.get_metadata(self.name)
+        return self._metadata
+
     def __repr__(self):
         if self.is_full:
-            return f"<Snapshot {elf.name} [full]>"
+            return f"<Snapshot {self.name} [full]>"
         else:
             return f"<Snapshot {self.name} [{self.parent_name}]>"
 
     @property
     def is_full(self):
         # keep backwards compatibility for underscore metadata
-        return 'true' in [self._metadata.get('is_full'), self._metadata.get('isfull')]
+        metadata = self.metadata
+        return metadata.get('isfull') == 'true' or metadata.get('is_full') == 'true'
 
     @property
     def parent(self):
-        parent_name = self._metadata.get('parent')
+        parent_name = self.metadata.get('parent')
         return self._mgr.get(parent_name)
 
     @property
     def parent_name(self):
-        return self._metadata.get("parent")
-
-    def _is_healthy(self, visited=frozenset()):
-        if self.is_full:
-            return True
-        if self in visited:
-            self._reason_broken = self.CYCLE
-            return False  # we ended up with a cycle, abort
-        if self.parent is None:
-            self._reason_broken = self.MISSING_PARENT
-            return False  # missing parent
-        if not self.parent._is_healthy(visited.union([self])):
-            if self.parent._reason_broken == self.CYCLE:
-                self._reason_broken = self.CYCLE
-            else:
-                self._reason_broken = self.PARENT_BROKEN
-            return False
-        return True
+        return self.metadata.get("parent")
 
     @property
-    @cached
     def is_healthy(self):
-        return self._is_healthy()
+        # classified for every snapshot by prefetch_metadata(), or on demand up the chain
+        if self._healthy is None:
+            self._mgr._classify_health([self])
+        return self._healthy
 
     @property
     def reason_broken(self):
@@ -119,31 +111,143 @@ class S3Snapshot(object):
 
     @property
     def compressor(self):
-        return self._metadata.get('compressor')
+        return self.metadata.get('compressor')
 
     @property
     def uncompressed_size(self):
-        return self._metadata.get('size')
+        return self.metadata.get('size')
 
 
 class S3SnapshotManager(object):
+    # sidecar object under s3_prefix with the metadata of uploaded snapshots, one json per line
+    MANIFEST = 'manifest.jsonl'
+
     def __init__(self, bucket, s3_prefix, snapshot_prefix):
         self.bucket = bucket
         self.s3_prefix = s3_prefix.rstrip('/') + '/'  # make sure we always have a trailing /
         self.snapshot_prefix = snapshot_prefix
 
-    @property
-    @cached
+    @functools.cached_property
     def _snapshots(self):
         prefix = os.path.join(self.s3_prefix, self.snapshot_prefix)
         snapshots = {}
         strip_chars = len(self.s3_prefix)
+        # the listing has the size but not the user metadata, that costs a HEAD per key
+        # so it's only fetched for the snapshots that end up needing it
         for key in self.bucket.objects.filter(Prefix=prefix):
-            key = self.bucket.Object(key.key)
             name = key.key[strip_chars:]
-            snapshots[name] = S3Snapshot(name, metadata=key.metadata, manager=self, size=key.content_length)
+            if name == self.MANIFEST:
+                continue
+            snapshots[name] = S3Snapshot(
+                name, metadata=None, manager=self, size=key.size, etag=key.e_tag)
         return snapshots
 
+    @functools.cached_property
+    def _manifest(self):
+        """The manifest's entries by snapshot name, empty if there's no manifest yet"""
+        try:
+            body = self.bucket.Object(self.s3_prefix + self.MANIFEST).get()['Body'].read()
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'NoSuchKey':
+                logging.warning("unable to read the snapshot manifest: %s", err)
+            return {}
+        entries = {}
+        for line in body.decode().splitlines():
+            if line:
+                entry = json.loads(line)
+                entries[entry['name']] = entry
+        return entries
+
+    def _manifest_metadata(self, snap):
+        # the listing stays authoritative, a manifest entry is only used while its
+        # etag matches the listed object so overwritten keys get a fresh HEAD
+        entry = self._manifest.get(snap.name)
+        if entry is not None and entry['etag'] == snap.etag:
+            return entry['metadata']
+
+    def get_metadata(self, name):
+        snap = self._snapshots.get(name)
+        metadata = self._manifest_metadata(snap) if snap is not None else None
+        if metadata is not None:
+            return metadata
+        return self.bucket.Object(self.s3_prefix + name).metadata
+
+    def _head_metadata(self, name):
+        # boto3 resources aren't thread safe, clients are, so the pooled HEADs use the client
+        response = self.bucket.meta.client.head_object(
+            Bucket=self.bucket.name, Key=self.s3_prefix + name)
+        return response['Metadata']
+
+    def update_manifest(self, names):
+        """Record the named, just uploaded, snapshots in the manifest and drop the entries
+        of snapshots that are gone from the listing. One HEAD per new snapshot.
+        """
+        # the manifest is shared by every dataset under s3_prefix but the listing only
+        # covers snapshot_prefix, entries outside of it are kept as they are
+        entries = {
+            name: entry for name, entry in self._manifest.items()
+            if not name.startswith(self.snapshot_prefix) or name in self._snapshots}
+        for name in names:
+            obj = self.bucket.Object(self.s3_prefix + name)
+            obj.load()
+            entries[name] = {'name': name, 'etag': obj.e_tag, 'metadata': obj.metadata}
+        body = ''.join(json.dumps(entry, sort_keys=True) + '\n' for entry in entries.values())
+        self.bucket.Object(self.s3_prefix + self.MANIFEST).put(Body=body.encode())
+
+    def prefetch_metadata(self, names=None):
+        """Fetch the metadata of the named snapshots, all of them by default, from the
+        manifest or with concurrent HEAD requests instead of one at a time as each
+        snapshot is inspected.
+        Health checks follow parent links read from the metadata so they can't
+        be fetched ahead any other way. Once all of it is known every snapshot's
+        health is classified in the same go.
+        """
+        snapshots = self._snapshots.values() if names is None else \
+            [self._snapshots[name] for name in names if name in self._snapshots]
+        missing = [snap for snap in snapshots if snap._metadata is None]
+        for snap in missing:
+            snap._metadata = self._manifest_metadata(snap)
+        missing = [snap for snap in missing if snap._metadata is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=METADATA_CONCURRENCY) as pool:
+                fetched = pool.map(self._head_metadata, [snap.name for snap in missing])
+                for snap, metadata in zip(missing, fetched):
+                    snap._metadata = metadata
+        if names is None:
+            self._classify_health()
+
+    def _classify_health(self, snapshots=None):
+        """Work out is_healthy and reason_broken for the given snapshots, all of them
+        by default. Each snapshot's parent chain is walked iteratively and only up to
+        the first snapshot that's already classified, so every snapshot is visited
+        once however long the chains are.
+        """
+        cycle, missing, broken = S3Snapshot.CYCLE, S3Snapshot.MISSING_PARENT, S3Snapshot.PARENT_BROKEN
+        for snap in self._snapshots.values() if snapshots is None else snapshots:
+            path, on_path = [], set()
+            node = snap
+            while True:
+                if node._healthy is not None:
+                    healthy, reason = node._healthy, node._reason_broken
+                    break
+                if node.is_full:
+                    healthy, reason = node._healthy, node._reason_broken = True, None
+                    break
+                if node in on_path:
+                    healthy, reason = False, cycle  # every snapshot on the path is in or leads into it
+                    break
+                parent = node.parent
+                if parent is None:
+                    healthy, reason = node._healthy, node._reason_broken = False, missing
+                    break
+                path.append(node)
+                on_path.add(node)
+                node = parent
+            if not healthy and reason != cycle:
+                reason = broken
+            for node in path:
+                node._healthy, node._reason_broken = healthy, reason
+
     def list(self):
         return sorted(self._snapshots.values(), key=operator.attrgetter('name'))
 
@@ -151,6 +255,16 @@ class S3SnapshotManager(object):
         return self._snapshots.get(name)
 
 
+def _stream_lines(cmd):
+    """Runs cmd and yields its stdout one decoded line at a time, while it's still running.
+    Raises CalledProcessError like subprocess.check_output if cmd fails.
+    """
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, encoding='utf-8') as proc:
+        yield from proc.stdout
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
 class ZFSSnapshot(object):
     def __init__(self, name, metadata, parent=None, manager=None):
         self.name = name
@@ -169,59 +283,66 @@ class ZFSSnapshotManager(object):
     def _list_snapshots(self):
         # This is overridden in tests
         # see FakeZFSManager
-        return subprocess.check_output(
-            ['zfs', 'list', '-Ht', 'snap', '-o',
-             'name,used,refer,mountpoint,written'])
+        # -d 1 limits the listing to this filesystem's own snapshots instead of every
+        # snapshot on every pool
+        return _stream_lines(
+            ['zfs', 'list', '-Ht', 'snap', '-r', '-d', '1', '-o',
+             'name,used,refer,mountpoint,written', self._fs_name])
 
     def datasets(self):
-        datasets = subprocess.check_output(['zfs', 'list'])
-        datasets = datasets.split(b'\n')
-        dataset_dicts = []
-        header = [x.lower() for x in datasets[0].split(b' ') if x]
-        for dataset in filter(lambda x: x, datasets[1:]):
-            dataset = [x for x in dataset.split(b' ') if x]
-            dataset_dicts.append(dict(zip(header, dataset)))
-        return dataset_dicts
+        """Returns the names of all local datasets"""
+        # -H gives one tab delimited, header-less line per dataset
+        return [line.rstrip('\n') for line in _stream_lines(['zfs', 'list', '-H', '-o', 'name'])]
+
+    @functools.cached_property
+    def _datasets(self):
+        return frozenset(self.datasets())
 
     def dataset_exists(self, dataset):
-        return dataset in [x[b'name'] for x in self.datasets()]
+        return dataset in self._datasets
 
     def _parse_snapshots(self):
-        """Returns all snapshots grouped by filesystem, a dict of OrderedDict's
+        """Returns the filesystem's snapshots that start with the snapshot prefix,
+        an OrderedDict indexed by snapshot name.
         The order of snapshots matters when determining parents for incremental send,
         so it's preserved.
-        Data is indexed by filesystem then for each filesystem we have an OrderedDict
-        of snapshots.
         """
+        prefix = self._snapshot_prefix
+        snapshots = OrderedDict()
         try:
-            snap = self._list_snapshots()
+            # lines are parsed as zfs list prints them
+            for line in self._list_snapshots():
+                line = line.rstrip('\n')
+                if len(line) == 0:
+                    continue
+                name, used, refer, mountpoint, written = line.split('\t')
+                vol_name, snap_name = name.split('@', 1)
+                if vol_name != self._fs_name:
+                    continue  # zfs list is scoped already, this guards overridden listings
+                if not snap_name.startswith(prefix):
+                    continue  # most of a pool's auto snapshots, skip them before building a dict
+                snapshots[snap_name] = {
+                    'name': name,
+                    'used': used,
+                    'refer': refer,
+                    'mountpoint': mountpoint,
+                    'written': written,
+                }
         except OSError as err:
             logging.error("unable to list local snapshots!")
-            return {}
-        vols = {}
-        for line in snap.splitlines():
-            if len(line) == 0:
-                continue
-            name, used, refer, mountpoint, written = line.decode().split('\t')
-            vol_name, snap_name = name.split('@', 1)
-            snapshots = vols.setdefault(vol_name, OrderedDict())
-            snapshots[snap_name] = {
-                'name': name,
-                'used': used,
-                'refer': refer,
-                'mountpoint': mountpoint,
-                'written': written,
-            }
-        return vols
+            return OrderedDict()
+        return snapshots
+
+    @functools.cached_property
+    def _parsed_snapshots(self):
+        # forking zfs list is the expensive part, do it once per manager
+        return self._parse_snapshots()
 
     def _build_snapshots(self, fs_name):
         snapshots = OrderedDict()
-        # for fs_name, fs_snaps in self._parse_snapshots().items():
-        fs_snaps = self._parse_snapshots().get(fs_name, {})
+        fs_snaps = self._parsed_snapshots
         parent = None
         for snap_name, data in fs_snaps.items():
-            if not snap_name.startswith(self._snapshot_prefix):
-                continue
             full_name = f'{fs_name}@{snap_name}'
             zfs_snap = ZFSSnapshot(
                 full_name,
@@ -233,8 +354,7 @@ class ZFSSnapshotManager(object):
             parent = zfs_snap
         return snapshots
 
-    @property
-    @cached
+    @functools.cached_property
     def _snapshots(self):
         return self._build_snapshots(self._fs_name)
 
@@ -242,49 +362,80 @@ class ZFSSnapshotManager(object):
         return self._snapshots.values()
 
     def get_latest(self):
-        if len(self._snapshots) == 0:
-            cfg = get_config()
+        snapshots = self._snapshots
+        if not snapshots:
             raise SoftError(
-                f"Nothing to backup for filesystem '{cfg.get('FILESYSTEM')}'. Are you sure"
-                 f"SNAPSHOT_PREFIX='{cfg.get('SNAPSHOT_PREFIX')}' is correct?")
-        return list(self._snapshots.values())[-1]
+                f'Nothing to backup for filesystem "{self._fs_name}". Are you sure '
+                f'SNAPSHOT_PREFIX="{self._snapshot_prefix}" is correct?')
+        return next(reversed(snapshots.values()))
 
     def get(self, name):
         return self._snapshots.get(name)
 
 
+def _format_command(stages):
+    """Renders a pipeline the way it would be typed in a shell, for dry runs and errors"""
+    return " | ".join(
+        stage if isinstance(stage, str) else " ".join(shlex.quote(arg) for arg in stage)
+        for stage in stages)
+
+
 class CommandExecutor(object):
     @staticmethod
     def shell(cmd, dry_run=False, capture=False):
+        """Runs cmd, a list of stages with each one's stdout piped into the next one.
+        A stage is an argv list, or a string for the odd stage that needs a shell.
+        With capture the last stage's stdout and stderr are returned as text, only the
+        last CAPTURE_TAIL_LINES lines of it so long outputs aren't buffered whole.
+        """
         if dry_run:
-            print(cmd)
-        else:
-            try:
-            	if capture:
-            		res=subprocess.check_output(
-                    	cmd, shell=True, stderr=subprocess.STDOUT)
-            	else:
-            		res=subprocess.check_call(
-                    	cmd, shell=True)
-            	return res
-            except subprocess.CalledProcessError as err:
-            	print(f"Tried cmd: {err.cmd}\nError Msg: {err.stderr} from err")
-            	sys.exit('Oops :-(')
-
-    @property
-    @cached
+            print(_format_command(cmd))
+            return
+        procs = []
+        stdin = None
+        error = None
+        try:
+            for index, stage in enumerate(cmd):
+                last = index == len(cmd) - 1
+                proc = subprocess.Popen(
+                    stage, shell=isinstance(stage, str), stdin=stdin,
+                    stdout=subprocess.PIPE if capture or not last else None,
+                    stderr=subprocess.STDOUT if capture and last else None)
+                if stdin is not None:
+                    stdin.close()  # the next stage owns it now, upstream gets EPIPE if it exits
+                stdin = proc.stdout
+                procs.append(proc)
+            output = None
+            if capture:
+                with procs[-1].stdout as out:
+                    output = b''.join(deque(out, maxlen=CAPTURE_TAIL_LINES))
+        except OSError as err:  # a stage failed to start
+            if stdin is not None:
+                stdin.close()
+            output, error = None, err
+        for proc in procs:
+            proc.wait()
+        failed = [proc.returncode for proc in procs if proc.returncode]
+        if error is not None or failed:
+            msg = error if error is not None else f"exit status {failed[0]}"
+            if output:
+                msg = f"{msg}\n{output.decode(errors='replace')}"
+            print(f"Tried cmd: {_format_command(cmd)}\nError Msg: {msg}")
+            sys.exit('Oops :-(')
+        return output.decode() if capture else 0
+
+    @functools.cached_property
     def has_pv(self):
         return subprocess.call(
             ['which', 'pv'],
             stderr=subprocess.STDOUT, stdout=subprocess.PIPE) == 0
 
-    def pipe(self, cmd1, cmd2, quiet=False, estimated_size=None, **kwa):
-        """Executes commands"""
+    def pipe(self, cmd, quiet=False, estimated_size=None, **kwa):
+        """Executes the stages in cmd as one pipeline, with pv after the first one"""
         if self.has_pv and not quiet:
-            pv = "pv" if estimated_size is None else f"pv --size {estimated_size}"
-            return self.shell(f"{cmd1} | {pv}| {cmd2}", **kwa)
-        else:
-            return self.shell("{cmd1} | {cmd2}", **kwa)
+            pv = ['pv'] if estimated_size is None else ['pv', '--size', str(estimated_size)]
+            cmd = [cmd[0], pv] + list(cmd[1:])
+        return self.shell(cmd, **kwa)
 
 
 class PairManager(object):
@@ -294,16 +445,30 @@ class PairManager(object):
         self._cmd = command_executor or CommandExecutor()
         self.compressor = compressor
 
-    def list(self):
-        pairs = []
-        seen = set([])
-        for z_snap in self.zfs_manager.list():
-            seen.add(z_snap.name)
-            pairs.append(
-                (self.s3_manager.get(z_snap.name), z_snap))
-        for s3_snap in self.s3_manager.list():
-            if s3_snap.name not in seen:
-                pairs.append((s3_snap, None))
+    def list(self, prefetch_metadata=False):
+        """Pairs up the local and S3 snapshots. With prefetch_metadata the S3 snapshots'
+        metadata is fetched too, alongside zfs list rather than after it.
+        """
+        def s3_listing():
+            if prefetch_metadata:
+                self.s3_manager.prefetch_metadata()  # lists S3 first
+            return self.s3_manager._snapshots
+
+        # zfs list and the S3 side are both slow and independent, overlap them;
+        # the managers cache what they fetched so the lookups below are free
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            listings = [
+                pool.submit(lambda: self.zfs_manager._snapshots),
+                pool.submit(s3_listing),
+            ]
+            for listing in listings:
+                listing.result()  # re-raise whatever failed
+        # join on the snapshot names: local snapshots in zfs order, then the ones
+        # that only exist in S3 sorted by name
+        z_by_name = self.zfs_manager._snapshots
+        s3_by_name = self.s3_manager._snapshots
+        pairs = [(s3_by_name.get(name), z_snap) for name, z_snap in z_by_name.items()]
+        pairs.extend((s3_by_name[name], None) for name in sorted(s3_by_name.keys() - z_by_name.keys()))
         return pairs
 
     def _snapshot_to_backup(self, snap_name):
@@ -318,7 +483,8 @@ class PairManager(object):
     @staticmethod
     def _parse_estimated_size(output):
         try:
-            size_line = [line for line in output.splitlines() if len(line)][-1]
+            # the total is on the last line, after the per snapshot estimates
+            size_line = next(line for line in reversed(output.splitlines()) if len(line))
             _, size = size_line.split()
             return int(size)
         except:
@@ -326,12 +492,11 @@ class PairManager(object):
             raise
 
     def _compress(self, cmd):
-        """Adds the appropriate command to compress the zfs stream"""
+        """Adds the appropriate command to compress the zfs stream, returns the stages"""
         compressor = COMPRESSORS.get(self.compressor)
         if compressor is None:
-            return cmd
-        compress_cmd = compressor['compress']
-        return f"{compress_cmd} | {cmd}"
+            return [cmd]
+        return [shlex.split(compressor['compress']), cmd]
 
     def _decompress(self, cmd, s3_snap):
         """Adds the appropriate command to decompress the zfs stream
@@ -339,9 +504,8 @@ class PairManager(object):
         """
         compressor = COMPRESSORS.get(s3_snap.compressor)
         if compressor is None:
-            return cmd
-        decompress_cmd = compressor['decompress']
-        return f"{decompress_cmd} | {cmd}"
+            return [cmd]
+        return [shlex.split(compressor['decompress']), cmd]
 
     def _pput_cmd(self, estimated, s3_prefix, snap_name, parent=None):
         meta = [f"size={estimated}"]
@@ -351,15 +515,18 @@ class PairManager(object):
             meta.append(f"parent={parent}")
         if self.compressor is not None:
             meta.append(f"compressor={self.compressor}")
-        return f"pput --quiet --estimated {estimated} {' '.join('--meta '+m for m in meta)} {s3_prefix}{snap_name}"
+        cmd = ['pput', '--quiet', '--estimated', str(estimated)]
+        for m in meta:
+            cmd.extend(['--meta', m])
+        return cmd + [f"{s3_prefix}{snap_name}"]
 
     def backup_full(self, snap_name=None, dry_run=False):
         """Do a full backup of a snapshot. By default latest local snapshot"""
         z_snap = self._snapshot_to_backup(snap_name)
         estimated_size = self._parse_estimated_size(
-            self._cmd.shell(f'zfs send -nvP {z_snap.name}',capture=True))
-        self._cmd.pipe(f"zfs send '{z_snap.name}'",
-            self._compress(
+            self._cmd.shell([['zfs', 'send', '-nvP', z_snap.name]], capture=True))
+        self._cmd.pipe(
+            [['zfs', 'send', z_snap.name]] + self._compress(
                 self._pput_cmd(
                     estimated=estimated_size,
                     s3_prefix=self.s3_manager.s3_prefix,
@@ -375,16 +542,18 @@ class PairManager(object):
         required for an incremental backup.
         """
         z_snap = self._snapshot_to_backup(snap_name)
+        self.s3_manager.prefetch_metadata()  # checking the chain's health reads all of it
         to_upload = []
         current = z_snap
         uploaded_meta = []
+        s3_get = self.s3_manager.get  # looked up once per snapshot in the chain
         while True:
-            s3_snap = self.s3_manager.get(current.name)
+            s3_snap = s3_get(current.name)
             if s3_snap is not None:
                 if not s3_snap.is_healthy:
                     # abort everything if we run in to unhealthy snapshots
                     raise IntegrityError(
-                        "Broken snapshot detected {s3_snap.name}, reason: '{s3_snap.reason_broken}'")
+                        f"Broken snapshot detected {s3_snap.name}, reason: '{s3_snap.reason_broken}'")
                 break
             to_upload.append(current)
             if current.parent is None:
@@ -395,10 +564,10 @@ class PairManager(object):
             print(z_snap)
             estimated_size = self._parse_estimated_size(
                 self._cmd.shell(
-                    f"zfs send -nvP -i '{z_snap.parent.name}' '{z_snap.name}'",
+                    [['zfs', 'send', '-nvP', '-i', z_snap.parent.name, z_snap.name]],
                     capture=True))
-            self._cmd.pipe(f"zfs send -i '{z_snap.parent.name}' '{z_snap.name}'",
-                self._compress(
+            self._cmd.pipe(
+                [['zfs', 'send', '-i', z_snap.parent.name, z_snap.name]] + self._compress(
                     self._pput_cmd(
                         estimated=estimated_size,
                         parent=z_snap.parent.name,
@@ -417,9 +586,11 @@ class PairManager(object):
         current_snap = self.s3_manager.get(snap_name)
         if current_snap is None:
             raise Exception(f'Sorry, no such snapshot: {snap_name}')
+        self.s3_manager.prefetch_metadata()  # checking the chain's health reads all of it
         to_restore = []
+        zfs_get = self.zfs_manager.get  # looked up once per snapshot in the chain
         while True:
-            z_snap = self.zfs_manager.get(current_snap.name)
+            z_snap = zfs_get(current_snap.name)
             if z_snap is not None:
                 print(f"Snapshot already exists locally. If you'd like to rollback to it you can run 'zfs rollback {current_snap.name}'")
                 break
@@ -431,14 +602,15 @@ class PairManager(object):
                 break
             else:
                 current_snap = current_snap.parent
-        force = '-F ' if force is True else ''
+        force = ['-F'] if force is True else []
         for s3_snap in reversed(to_restore):
-            self._cmd.pipe(f"zfs3backup_get {os.path.join(self.s3_manager.s3_prefix, s3_snap.name)}",
-                           self._decompress(cmd=f"zfs recv {force}{s3_snap.name}",
-                           s3_snap=s3_snap,),dry_run=dry_run,
+            self._cmd.pipe([['zfs3backup_get', os.path.join(self.s3_manager.s3_prefix, s3_snap.name)]] +
+                           self._decompress(cmd=['zfs', 'recv'] + force + [s3_snap.name],
+                           s3_snap=s3_snap,), dry_run=dry_run,
                            estimated_size=s3_snap.size,)
 
 
+@functools.lru_cache(maxsize=1024)
 def _humanize(size):
     units = ('M', 'G', 'T')
     unit_index = 0
@@ -451,27 +623,49 @@ def _humanize(size):
     return f"{size} {units[unit_index]}"
 
 
-def _get_widths(widths, line):
-    for index, value in enumerate(line):
-        widths[index] = max(widths[index], len(f"{value}"))
-    return widths
+def _short_name(snap_name):
+    return snap_name.split('@', 1)[-1]
+
+
+def _pair_name(pair):
+    s3_snap, z_snap = pair
+    return _short_name((s3_snap or z_snap).name)
+
+
+def _get_widths(header, pairs):
+    """Column widths for the status listing, worked out without preparing the lines.
+    Only the names vary, the other columns have a known set of values.
+    """
+    name_width = max([len(header[0])] + [len(_pair_name(pair)) for pair in pairs])
+    parent_width = max([len(header[1])] + [
+        len(_short_name(s3_snap.parent_name)) for s3_snap, _ in pairs
+        if s3_snap is not None and not s3_snap.is_full])
+    fixed = (
+        len('incremental'),
+        max(len(S3Snapshot.MISSING_PARENT), len(S3Snapshot.CYCLE), len(S3Snapshot.PARENT_BROKEN)),
+        len('missing'),
+        len('1023.99 M'),  # _humanize moves to the next unit past 1024
+    )
+    return [name_width, parent_width] + [max(len(col), w) for col, w in zip(header[2:], fixed)]
 
 
 def _prepare_line(s3_snap, z_snap):
     if s3_snap is None:
         snap_type = 'missing'
         health = '-'
-        name = z_snap.name.split('@', 1)[1]
+        name = _short_name(z_snap.name)
         parent_name = '-'
         local_state = 'ok'
         size = ''
     else:
-        snap_type = 'full' if s3_snap.is_full else 'incremental'
+        is_full = s3_snap.is_full
+        snap_type = 'full' if is_full else 'incremental'
         health = s3_snap.reason_broken or 'ok'
-        parent_name = '' if s3_snap.is_full else s3_snap.parent_name.split('@', 1)[1]
-        name = s3_snap.name.split('@', 1)[1]
+        parent_name = '' if is_full else _short_name(s3_snap.parent_name)
+        name = _short_name(s3_snap.name)
         local_state = 'ok' if z_snap is not None else 'missing'
-        size = _humanize(s3_snap.uncompressed_size) if s3_snap.uncompressed_size is not None else ''
+        uncompressed_size = s3_snap.uncompressed_size
+        size = _humanize(uncompressed_size) if uncompressed_size is not None else ''
     #print(name, parent_name, snap_type, health, local_state, size)
     return (name, parent_name, snap_type, health, local_state, size)
 
@@ -483,16 +677,14 @@ def list_snapshots(bucket, s3_prefix, filesystem, snapshot_prefix):
         S3SnapshotManager(bucket, s3_prefix=s3_prefix, snapshot_prefix=prefix),
         ZFSSnapshotManager(fs_name=filesystem, snapshot_prefix=snapshot_prefix))
     header = ("NAME", "PARENT", "TYPE", "HEALTH", "LOCAL STATE", "SIZE")
-    widths = [len(col) for col in header]
-    listing = []
-    for s3_snap, z_snap in pair_manager.list():
-        line = _prepare_line(s3_snap, z_snap)
-        listing.append(line)
-        widths = _get_widths(widths, line)
-    fmt = " | ".join("{{:{w}}}".format(w=w) for w in widths)
+    # every line shows some of the metadata
+    pairs = pair_manager.list(prefetch_metadata=True)
+    # sorting by name only needs the pairs, lines are prepared and printed one at a time
+    pairs = sorted(pairs, key=_pair_name)
+    fmt = " | ".join("{{:{w}}}".format(w=w) for w in _get_widths(header, pairs))
     print(fmt.format(*header))
-    for line in sorted(listing):
-        print(fmt.format(*line))
+    for s3_snap, z_snap in pairs:
+        print(fmt.format(*_prepare_line(s3_snap, z_snap)))
 
 
 def do_backup(bucket, s3_prefix, filesystem, snapshot_prefix, full, snapshot, compressor, dry, parseable):
@@ -501,10 +693,21 @@ def do_backup(bucket, s3_prefix, filesystem, snapshot_prefix, full, snapshot, co
     zfs_mgr = ZFSSnapshotManager(fs_name=filesystem, snapshot_prefix=snapshot_prefix)
     pair_manager = PairManager(s3_mgr, zfs_mgr, compressor=compressor)
     snap_name = f"{filesystem}@{snapshot}" if snapshot else None
+    if not dry:
+        # pput runs --quiet under us, so this is the only place the warning can show up
+        warning = slow_sha256_warning()
+        if warning is not None:
+            sys.stderr.write(f"{warning}\n")
     if full is True:
         uploaded = pair_manager.backup_full(snap_name=snap_name, dry_run=dry)
     else:
         uploaded = pair_manager.backup_incremental(snap_name=snap_name, dry_run=dry)
+    if uploaded and not dry:
+        try:
+            s3_mgr.update_manifest([meta['snap_name'] for meta in uploaded])
+        except (ClientError, BotoCoreError) as err:
+            # the backup itself succeeded, listings fall back to HEAD requests
+            logging.warning("unable to update the snapshot manifest: %s", err)
     for meta in uploaded:
         if parseable:
             print("{snap_name}\x00{size}".format(**meta))
@@ -590,10 +793,13 @@ def main():
     except KeyError as err:
         sys.stderr.write(f"Configuration error! {err} is not set.\n")
         sys.exit(1)
+    # room for one connection per concurrent metadata HEAD
+    config = Config(max_pool_connections=METADATA_CONCURRENCY)
     if cfg['ENDPOINT']== 'aws':   # boto3.resource makes an intelligent decision with the default url
-        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource('s3')
+        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource('s3', config=config)
     else:
-        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource('s3',endpoint_url=cfg['ENDPOINT'])
+        s3 = boto3.Session(profile_name=cfg['PROFILE']).resource(
+            's3', endpoint_url=cfg['ENDPOINT'], config=config)
         
     bucket = s3.Bucket(bucket)
     
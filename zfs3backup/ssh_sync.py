@@ -1,11 +1,11 @@
 from __future__ import print_function
 
 import argparse
-import subprocess
+import shlex
 import sys
 
 from zfs3backup.config import get_config
-from zfs3backup.snap import ZFSSnapshotManager, CommandExecutor
+from zfs3backup.snap import ZFSSnapshotManager, CommandExecutor, _stream_lines
 
 
 quiet = False
@@ -17,9 +17,10 @@ class RemoteZFSSnapshotManager(ZFSSnapshotManager):
         self.remote_addr = remote_addr
 
     def _list_snapshots(self):
-        return subprocess.check_output(
+        return _stream_lines(
             ['ssh', self.remote_addr, '-C',
-             'sudo zfs list -Ht snap -o name,used,refer,mountpoint,written'])
+             'sudo zfs list -Ht snap -r -d 1 -o name,used,refer,mountpoint,written '
+             + shlex.quote(self._fs_name)])
 
 
 def snapshots_to_send(source_snaps, dest_snaps):
@@ -59,7 +60,7 @@ def send_snapshots(send_cmd, recv_cmd, remote_addr):
 
 def pull_snapshots(send_cmd, recv_cmd, remote_addr):
     send_cmd = f"ssh {remote_addr} -C 'sudo {send_cmd}'"
-    recv_cmd = "mbuffer -s 128k -m 200m -q | {recv_cmd}"
+    recv_cmd = f"mbuffer -s 128k -m 200m -q | {recv_cmd}"
     return send_cmd, recv_cmd
 
 
@@ -137,7 +138,8 @@ def main():
         return
     send_cmd, recv_cmd = cmd_pair
     executor = CommandExecutor()
-    executor.pipe(send_cmd, recv_cmd, quiet=quiet)
+    # both commands rely on shell quoting and pipes, so they run as shell stages
+    executor.pipe([send_cmd, recv_cmd], quiet=quiet)
 
 
 if __name__ == '__main__':